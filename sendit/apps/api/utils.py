@@ -21,8 +21,7 @@ SOFTWARE.
 
 '''
 
-from sendit.apps.main.utils import ls_fullpath
-import os
+from sendit.apps.main.utils import get_inventory_size
 
 def get_size(batch):
     '''get the size of a batch, in gb
@@ -36,7 +35,6 @@ def get_size(batch):
             do_calculation = True
     if do_calculation is True: 
         batch_folder = "/data/%s" %(batch.uid)
-        dicom_files = ls_fullpath(batch_folder)
-        batch.qa['SizeBytes'] = sum(os.path.getsize(f) for f in dicom_files)
+        batch.qa['SizeBytes'] = get_inventory_size(batch_folder)
         batch.save()
     return batch.qa['SizeBytes']/(1024*1024*1024.0)  # bytes to GB
@@ -35,7 +35,9 @@ import hashlib
 
 from sendit.settings import API_VERSION as APIVERSION
 from sendit.apps.api.utils import get_size
+from sendit.apps.main.scheduling import get_scheduler_metrics
 from sendit.apps.main.utils import get_database
+from sendit.apps.watcher.utils import get_watcher_metrics
 from sendit.apps.main.models import (
     Batch,
     Image
@@ -95,7 +97,9 @@ def metrics_view(request):
     response = {"timestamp":timestamp,
                 "data_root": base,
                 "data_total": len(glob("%s/*" %(base))),
-                "batches": batchlog}
+                "batches": batchlog,
+                "scheduler": get_scheduler_metrics(),
+                "watcher": get_watcher_metrics()}
 
     return JsonResponse(response)
 
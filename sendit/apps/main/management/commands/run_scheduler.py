@@ -0,0 +1,32 @@
+from sendit.logger import bot
+from django.core.management.base import BaseCommand
+from sendit.apps.main.scheduling import run_scheduler
+
+
+class Command(BaseCommand):
+    help = '''run scheduler will keep a target number of batches in each
+              stage (NEW or PROCESSING), submitting batches from the QUEUE as others
+              finish, and looking for new folders when the QUEUE runs low. It
+              runs until stopped, and can be run on more than one node.
+           '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', dest='target', default=None, type=int)
+        parser.add_argument('--processing', dest='processing', default=None, type=int)
+        parser.add_argument('--interval', dest='interval', default=None, type=float)
+        parser.add_argument('--subfolder', dest='base', default=None, type=str)
+        parser.add_argument('--once', dest='once', default=False, action='store_true')
+
+    def handle(self,*args, **options):
+        targets = dict()
+        if options['target'] is not None:
+            targets['NEW'] = options['target']
+        if options['processing'] is not None:
+            targets['PROCESSING'] = options['processing']
+
+        state = run_scheduler(targets=targets,
+                              interval=options['interval'],
+                              subfolder=options['base'],
+                              once=options['once'])
+        if state is not None:
+            bot.info("%s in flight, %s in QUEUE." %(state['InFlight'], state['Queue']))
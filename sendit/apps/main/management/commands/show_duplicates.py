@@ -0,0 +1,27 @@
+from sendit.logger import bot
+from sendit.apps.main.models import (
+    Batch,
+    Instance
+)
+from django.core.management.base import (
+    BaseCommand
+)
+
+
+class Command(BaseCommand):
+    help = '''show the number of images skipped on import because they were
+              already imported with another batch, and the bytes saved'''
+
+    def handle(self,*args, **options):
+
+        count = 0
+        size_bytes = 0
+        batches = 0
+        for batch in Batch.objects.filter(qa__Duplicates__gt=0):
+            count += batch.qa['Duplicates']
+            size_bytes += batch.qa.get('DuplicateBytes',0)
+            batches += 1
+
+        bot.info("%s images indexed for duplicates." %Instance.objects.count())
+        bot.info("%s duplicate images skipped in %s batches." %(count,batches))
+        bot.info("%s MB saved." %(size_bytes/(1024*1024.0)))
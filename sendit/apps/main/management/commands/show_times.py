@@ -6,10 +6,9 @@ from django.core.management.base import (
 
 from sendit.apps.main.models import Batch
 from sendit.apps.main.tasks import import_dicomdir
-from sendit.apps.main.utils import ls_fullpath
+from sendit.apps.main.utils import get_inventory_size
 
 import sys
-import os
 
 
 def get_size(batch):
@@ -22,8 +21,7 @@ def get_size(batch):
             do_calculation = True
     if do_calculation is True: 
         batch_folder = "/data/%s" %(batch.uid)
-        dicom_files = ls_fullpath(batch_folder)
-        batch.qa['SizeBytes'] = sum(os.path.getsize(f) for f in dicom_files)
+        batch.qa['SizeBytes'] = get_inventory_size(batch_folder)
         batch.save()
     return batch.qa['SizeBytes']/(1024*1024.0)  # bytes to MB
   
@@ -12,9 +12,9 @@ class Command(BaseCommand):
               2. Second preference,  a single subfolder at the base (eg /data/<subfolder>) 
               3. The data base alone (/data)
 
-           and submit async jobs to the queue for all new findings. We run this once,
-           with the same process, to prevent race conditions if different workers
-           were looking for new folders at the same time.
+           and submit async jobs to the queue for all new findings. Batches are
+           claimed before they are submitted, so this can be run by more than
+           one process (or node) at once.
            '''
 
     def add_arguments(self, parser):
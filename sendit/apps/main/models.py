@@ -4,6 +4,8 @@ Images models.
   Batch: a folder with a set of images associated with a C-MOVE query
   Image: one dicom image associated with a batch
   BatchIdentifiers: identifiers to be used to de-identify images
+  Instance: a dicom instance (SOPInstanceUID and content) seen on import
+  Lease: a lock (with expiry) held by a task working on a batch
 
 Copyright (c) 2017 Vanessa Sochat
 
@@ -34,9 +36,13 @@ from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.core.urlresolvers import reverse
 from django.db.models.signals import m2m_changed
-from django.db.models import Q, DO_NOTHING
-from django.db import models
+from django.db.models import Q, DO_NOTHING, SET_NULL
+from django.db import (
+    models,
+    transaction
+)
 from django.conf import settings
+from django.utils import timezone
 from sendit.settings import MEDIA_ROOT
 
 import collections
@@ -80,6 +86,30 @@ ERROR_STATUS = ((True,'The batch had an error at some point, and errors should b
 #################################################################################################
 
 
+class BatchManager(models.Manager):
+
+    def claim(self, count=None, ids=None, status="QUEUE", claimed="NEW"):
+        '''claim will atomically change up to count batches (optionally, of
+        a list of ids) from status to claimed, and return them. Rows locked by
+        another claim (eg, a scheduler on another node) are skipped, so two
+        callers never get the same batch.
+        '''
+        with transaction.atomic():
+            batches = self.select_for_update(skip_locked=True).filter(status=status)
+            if ids is not None:
+                batches = batches.filter(id__in=ids)
+            batches = batches.order_by('add_date', 'id')
+            if count is not None:
+                batches = batches[:count]
+            batches = list(batches)
+            self.filter(id__in=[x.id for x in batches]).update(status=claimed,
+                                                               modify_date=timezone.now())
+        for batch in batches:
+            batch.status = claimed
+        return batches
+
+
+
 class Batch(models.Model):
     '''A batch has one or more images for some number of patients, each of which
     is associated with a Study or Session. A batch maps cleanly to a folder that is
@@ -97,10 +127,11 @@ class Batch(models.Model):
                                     default=False,
                                     verbose_name="HasError")
 
-    qa = JSONField(default=dict())
-    logs = JSONField(default=dict())
+    qa = JSONField(default=dict)
+    logs = JSONField(default=dict)
     modify_date = models.DateTimeField('date modified', auto_now=True)
     tags = TaggableManager()
+    objects = BatchManager()
 
     def change_images_status(self,status):
         '''change all images to have the same status'''
@@ -156,6 +187,7 @@ class Image(models.Model):
     name = models.CharField(max_length=250, null=False, blank=False)
 
     image = models.FileField(upload_to=get_upload_folder,null=True,blank=False)
+    header = JSONField(default=dict) # header index, see tasks.utils
     add_date = models.DateTimeField('date added', auto_now_add=True)
     modify_date = models.DateTimeField('date modified', auto_now=True)
     batch = models.ForeignKey(Batch,null=False,blank=False)
@@ -213,11 +245,11 @@ class BatchIdentifiers(models.Model):
     batch = models.ForeignKey(Batch,null=False,blank=False)
     add_date = models.DateTimeField('date added', auto_now_add=True)
     modify_date = models.DateTimeField('date modified', auto_now=True)
-    response = JSONField(default=dict())
-    ids = JSONField(default=dict())
-    shared = JSONField(default=dict()) # shared identifiers
-    updated = JSONField(default=dict())
-    cleaned = JSONField(default=dict())
+    response = JSONField(default=dict)
+    ids = JSONField(default=dict)
+    shared = JSONField(default=dict) # shared identifiers
+    updated = JSONField(default=dict)
+    cleaned = JSONField(default=dict)
 
     def __str__(self):
         return "%s" %self.id
@@ -230,3 +262,66 @@ class BatchIdentifiers(models.Model):
 
     class Meta:
         app_label = 'main'
+
+
+#################################################################################################
+# Instances #####################################################################################
+#################################################################################################
+
+
+class Instance(models.Model):
+    '''An instance is a dicom image (by SOPInstanceUID and a checksum of the
+    file) imported with a batch, used to find the same image sent again
+    with another batch. Only an instance confirmed (when the batch was
+    uploaded) counts as a duplicate.
+    '''
+    uid = models.CharField(max_length=250, null=False, blank=False, db_index=True)
+    checksum = models.CharField(max_length=32, null=False, blank=False)
+    size = models.BigIntegerField(default=0)
+    batch = models.ForeignKey(Batch,null=True,blank=True,on_delete=SET_NULL)
+    confirmed = models.BooleanField(default=False) # uploaded with the batch
+    add_date = models.DateTimeField('date added', auto_now_add=True)
+
+    def __str__(self):
+        return "%s-%s" %(self.id,self.uid)
+
+    def __unicode__(self):
+        return "%s-%s" %(self.id,self.uid)
+ 
+    def get_label(self):
+        return "instance"
+
+    class Meta:
+        app_label = 'main'
+        unique_together = ('uid','checksum',)
+
+
+#################################################################################################
+# Leases ########################################################################################
+#################################################################################################
+
+
+class Lease(models.Model):
+    '''A lease is held by a task (name) working on a batch (key, the batch uid)
+    so that the same work submitted more than once is only done by one worker.
+    A lease that is not released (eg, the worker died) can be taken when
+    it expires.
+    '''
+    name = models.CharField(max_length=250, null=False, blank=False)
+    key = models.CharField(max_length=250, null=False, blank=False)
+    owner = models.CharField(max_length=36, null=False, blank=False)
+    expires = models.DateTimeField('date expires')
+    add_date = models.DateTimeField('date added', auto_now_add=True)
+
+    def __str__(self):
+        return "%s-%s" %(self.name,self.key)
+
+    def __unicode__(self):
+        return "%s-%s" %(self.name,self.key)
+ 
+    def get_label(self):
+        return "lease"
+
+    class Meta:
+        app_label = 'main'
+        unique_together = ('name','key',)
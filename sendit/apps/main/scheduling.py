@@ -0,0 +1,331 @@
+'''
+Scheduling policies, to choose the order that batches waiting in QUEUE are
+submitted by start_queue (see QUEUE_POLICY in settings/config.py), and the
+scheduler that keeps a target number of batches in flight (run_scheduler)
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from sendit.logger import bot
+from sendit.apps.main.models import (
+    Batch,
+    Lease
+)
+from sendit.apps.main.utils import (
+    get_capacity,
+    get_inventory,
+    submit_batches,
+    update_cached,
+    upload_finished
+)
+from sendit.settings import (
+    QUEUE_AGING_SECONDS,
+    QUEUE_FAIR_WEIGHTS,
+    QUEUE_POLICY,
+    QUEUE_POLICY_WINDOW,
+    SCHEDULER_INTERVAL,
+    SCHEDULER_METRICS,
+    SCHEDULER_RESCAN_INTERVAL,
+    SCHEDULER_STALE_SECONDS,
+    SCHEDULER_TARGETS,
+    SCHEDULER_UPLOAD_INTERVAL
+)
+from datetime import timedelta
+import heapq
+import json
+import time
+import os
+
+
+def get_folder_stats(batch):
+    '''get folder stats returns the (bytes, files) of the folder of a batch
+    in QUEUE, from one read of the folder. These are kept in the batch logs,
+    so a folder is only read once while it waits.
+    '''
+    if 'QueueBytes' not in batch.logs:
+        size = 0
+        count = 0
+        dicom_dir = batch.logs.get('DICOM_DIR')
+        try:
+            for entry in get_inventory(dicom_dir):
+                if entry['is_file']:
+                    size += entry['size']
+                    count += 1
+        except (FileNotFoundError, TypeError):
+            bot.warning("Cannot read folder %s for batch %s" %(dicom_dir, batch.uid))
+        batch.logs['QueueBytes'] = size
+        batch.logs['QueueFiles'] = count
+
+        # Only the logs are saved, to the current row (it may be claimed)
+        with transaction.atomic():
+            current = Batch.objects.select_for_update().filter(id=batch.id).first()
+            if current is not None:
+                current.logs['QueueBytes'] = size
+                current.logs['QueueFiles'] = count
+                current.save(update_fields=['logs'])
+    return batch.logs['QueueBytes'], batch.logs['QueueFiles']
+
+
+def get_wait(batch, now=None):
+    '''return the seconds a batch has been waiting since it was added'''
+    if now is None:
+        now = timezone.now()
+    return max((now - batch.add_date).total_seconds(), 0)
+
+
+#### POLICIES ##########################################################
+
+def fifo(batches):
+    '''first in first out, in the order the batches were added'''
+    return sorted(batches, key=lambda x: (x.add_date, x.id))
+
+
+def smallest_first(batches):
+    '''the smallest folders (in bytes, then files) first, so many small
+    studies are not stuck behind one large one'''
+    return sorted(batches, key=lambda x: (get_folder_stats(x), x.add_date))
+
+
+def aging(batches, aging_seconds=None):
+    '''the smallest folders first, but a folder counts as half its size for
+    each aging_seconds it has waited, so large studies are not starved'''
+    if aging_seconds is None:
+        aging_seconds = QUEUE_AGING_SECONDS
+    now = timezone.now()
+
+    def get_priority(batch):
+        size = get_folder_stats(batch)[0]
+        return size / 2.0 ** (get_wait(batch, now) / aging_seconds)
+
+    return sorted(batches, key=lambda x: (get_priority(x), x.add_date))
+
+
+def fair_share(batches, weights=None):
+    '''weighted fair share across input folders (the parent of each batch
+    folder, eg /data/<date>). Each input folder is given a share of the
+    bytes submitted in proportion to its weight (default 1), so one input
+    folder with many (or large) studies can't hold back the others. Within
+    an input folder, batches are first in first out.
+    '''
+    if weights is None:
+        weights = QUEUE_FAIR_WEIGHTS
+
+    queues = dict()
+    for batch in fifo(batches):
+        parent = os.path.dirname(batch.logs.get('DICOM_DIR') or '')
+        queues.setdefault(parent, []).append(batch)
+
+    # The input folder with the least (weighted) bytes submitted goes next
+    heap = [(0, parent) for parent in sorted(queues)]
+    ordered = []
+    while len(heap) > 0:
+        used, parent = heapq.heappop(heap)
+        batch = queues[parent].pop(0)
+        ordered.append(batch)
+        if len(queues[parent]) > 0:
+            weight = weights.get(parent, 1)
+            size = get_folder_stats(batch)[0]
+            heapq.heappush(heap, (used + max(size, 1) / float(weight), parent))
+    return ordered
+
+
+POLICIES = {'fifo': fifo,
+            'smallest': smallest_first,
+            'aging': aging,
+            'fair': fair_share}
+
+
+def get_policy(policy=None):
+    '''get policy returns the function for a scheduling policy, one of the
+    names in POLICIES, or the dotted path to a function that takes a list
+    of batches and returns them in the order to submit'''
+    if policy is None:
+        policy = QUEUE_POLICY
+    if policy in POLICIES:
+        return POLICIES[policy]
+    return import_string(policy)
+
+
+def schedule_batches(batches, policy=None, window=None):
+    '''schedule batches returns batches in QUEUE (a queryset) in the order
+    to submit them. Only the window of batches waiting the longest are
+    ordered by the policy, so each call reads a bounded number of folders.
+    '''
+    if window is None:
+        window = QUEUE_POLICY_WINDOW
+    batches = batches.order_by('add_date', 'id')
+    if window is not None:
+        batches = batches[:window]
+    return get_policy(policy)(list(batches))
+
+
+#### SCHEDULER #########################################################
+
+def get_stages():
+    '''return the number of batches with each status'''
+    counts = Batch.objects.values_list('status').annotate(total=Count('id'))
+    return dict((status, total) for status, total in counts)
+
+
+def requeue_stale(max_age=None):
+    '''requeue stale will put batches that have been NEW (submitted) for
+    more than max_age seconds back in QUEUE, unless an import holds the
+    lease for the batch. These are batches with a task that was lost (eg,
+    with a worker or the broker), and would otherwise count as in flight
+    forever. A batch that finished import (and waits for identifiers), or
+    a shard of a batch, is not put back. Returns the number put back.
+    '''
+    if max_age is None:
+        max_age = SCHEDULER_STALE_SECONDS
+    if max_age is None:
+        return 0
+
+    now = timezone.now()
+    importing = Lease.objects.filter(name="import_dicomdir",
+                                     expires__gte=now).values_list('key', flat=True)
+    stale = Batch.objects.filter(status="NEW",
+                                 modify_date__lt=now - timedelta(seconds=max_age))
+    stale = stale.exclude(qa__has_key='ImportFinishTime').exclude(qa__has_key='Parent')
+    count = stale.exclude(uid__in=list(importing)).update(status="QUEUE",
+                                                          modify_date=now)
+    if count > 0:
+        bot.warning("%s batches were NEW for more than %s seconds, put back in QUEUE." %(count, max_age))
+    return count
+
+
+def schedule(state, targets=None, subfolder=None, rescan_interval=None,
+             upload_interval=None):
+    '''schedule is one step of the scheduler. Batches are submitted from QUEUE
+    so that each status in targets (eg, NEW and PROCESSING) has up to its
+    target batches, within the backlog limit (see get_capacity). A stage
+    over its target (eg, de-identification is behind) holds back new
+    batches. The folders are only checked for new batches (update_cached)
+    when the QUEUE has less than is needed, at most every rescan_interval
+    seconds. If upload_interval is set, batches that are DONEPROCESSING are
+    submitted for upload that often. The counts are kept in the state.
+    '''
+    if targets is None:
+        targets = SCHEDULER_TARGETS
+    if rescan_interval is None:
+        rescan_interval = SCHEDULER_RESCAN_INTERVAL
+    if upload_interval is None:
+        upload_interval = SCHEDULER_UPLOAD_INTERVAL
+
+    now = time.time()
+    state['Requeued'] += requeue_stale()
+    stages = get_stages()
+    in_flight = stages.get('NEW', 0) + stages.get('PROCESSING', 0)
+    room = min([max(target - stages.get(status, 0), 0)
+                for status, target in targets.items()] or [0])
+    capacity = get_capacity()
+    if capacity is not None:
+        room = min(room, capacity)
+
+    # Only look for new folders when the queue runs low
+    if stages.get('QUEUE', 0) < room and now - state['LastRescan'] >= rescan_interval:
+        update_cached(subfolder)
+        state['LastRescan'] = now
+        stages['QUEUE'] = Batch.objects.filter(status="QUEUE").count()
+
+    started = 0
+    if room > 0 and stages.get('QUEUE', 0) > 0:
+        contenders = schedule_batches(Batch.objects.filter(status="QUEUE"))
+        started = submit_batches(contenders, max_count=room)
+        if started > 0:
+            bot.info("Submitted %s batches, %s in flight." %(started, in_flight + started))
+
+    if upload_interval is not None and stages.get('DONEPROCESSING', 0) > 0:
+        if now - state['LastUpload'] >= upload_interval:
+            upload_finished(batches=True)
+            state['LastUpload'] = now
+
+    state['Targets'] = targets
+    state['InFlight'] = in_flight + started
+    state['Capacity'] = capacity
+    state['Queue'] = stages.get('QUEUE', 0) - started
+    state['Stages'] = stages
+    state['Submitted'] += started
+    state['LastRun'] = now
+    return state
+
+
+def run_scheduler(targets=None, interval=None, subfolder=None, once=False):
+    '''run scheduler will run a step of the scheduler (schedule) every
+    interval seconds, until stopped, writing its state to SCHEDULER_METRICS
+    (shown with the api metrics). targets updates SCHEDULER_TARGETS.
+    '''
+    if interval is None:
+        interval = SCHEDULER_INTERVAL
+    targets = dict(SCHEDULER_TARGETS, **(targets or {}))
+    state = {'StartTime': time.time(),
+             'LastRescan': 0,
+             'LastUpload': 0,
+             'Submitted': 0,
+             'Requeued': 0}
+
+    bot.info("Starting scheduler, every %s seconds." %interval)
+    while True:
+        try:
+            schedule(state, targets=targets, subfolder=subfolder)
+
+        # The database or broker may be down for a moment, try again
+        except Exception as e:
+            if once is True:
+                raise
+            bot.error("Scheduler step failed, trying again: %s" %e)
+
+        try:
+            save_scheduler_metrics(state)
+        except OSError as e:
+            bot.warning("Cannot write scheduler metrics to %s: %s" %(SCHEDULER_METRICS, e))
+        if once is True:
+            return state
+        time.sleep(interval)
+
+
+def save_scheduler_metrics(state):
+    '''write the scheduler state, replacing the file at once'''
+    folder = os.path.dirname(SCHEDULER_METRICS)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp_file = "%s.tmp" %SCHEDULER_METRICS
+    with open(tmp_file, 'w') as filey:
+        json.dump(state, filey)
+    os.replace(tmp_file, SCHEDULER_METRICS)
+
+
+def get_scheduler_metrics():
+    '''return the state written by the scheduler (eg, the batches in flight
+    and in QUEUE), or an empty dictionary if it isn't running.
+    '''
+    metrics = dict()
+    if os.path.exists(SCHEDULER_METRICS):
+        with open(SCHEDULER_METRICS,'r') as filey:
+            try:
+                metrics = json.load(filey)
+            except ValueError:
+                pass
+    return metrics
@@ -1,5 +1,6 @@
 from .get import (
     get_identifiers,
+    get_identifiers_many,
     import_dicomdir
 )
 
@@ -8,3 +9,8 @@ from .update import (
 )
 
 from .finish import upload_storage
+
+from .pipeline import (
+    finish_pipeline,
+    process_series
+)
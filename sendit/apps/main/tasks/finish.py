@@ -36,14 +36,19 @@ from sendit.apps.main.models import (
 )
 
 from .utils import (
+    acquire_lease,
     add_batch_error,
     add_batch_warning,
     change_status,
     chunks,
+    confirm_instances,
     prepare_entity_metadata,
+    release_lease,
+    start_heartbeat,
     generate_compressed_file,
     extract_study_ids,
     get_entity_images,
+    get_header_index,
     save_image_dicom
 )
 
@@ -59,6 +64,7 @@ from som.api.google.bigquery.schema import dicom_schema
 from retrying import retry
 from copy import deepcopy
 from django.conf import settings
+from django.db import transaction
 import time
 from random import choice
 from time import sleep
@@ -75,18 +81,43 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 @shared_task
 def upload_storage(batch_ids=None):
     '''upload storage will as a batch, send all batches with DONEPROCESSING status
-    to google cloud storage.
+    to google cloud storage. A batch being uploaded by another worker is skipped.
     '''
-    from sendit.settings import (GOOGLE_CLOUD_STORAGE,
-                                 SEND_TO_GOOGLE,
-                                 GOOGLE_PROJECT_NAME,
-                                 GOOGLE_STORAGE_COLLECTION)
-
     if batch_ids is None:
         batches = Batch.objects.filter(status="DONEPROCESSING")
     else:
         batches = Batch.objects.filter(status="DONEPROCESSING", id__in=batch_ids)
 
+    # Shards of a batch are uploaded together, when all are done
+    batches = join_shards(batches)
+
+    # Each batch is uploaded by one worker, and the status checked when held
+    leases = dict()
+    for batch in batches:
+        owner = acquire_lease("upload_storage", batch.uid)
+        if owner is not None:
+            leases[batch.id] = (batch.uid, owner)
+        else:
+            bot.warning("upload_storage is already running for %s, skipping." %batch.uid)
+    heartbeat = start_heartbeat("upload_storage", list(leases.values()))
+    try:
+        batches = Batch.objects.filter(status="DONEPROCESSING", id__in=list(leases.keys()))
+        return upload_batches(batches)
+    finally:
+        heartbeat.set()
+        for uid, owner in leases.values():
+            release_lease("upload_storage", uid, owner)
+
+
+def upload_batches(batches):
+    '''upload batches is called by upload_storage to send a set of batches
+    to google cloud storage, each as a compressed file with metadata.
+    '''
+    from sendit.settings import (GOOGLE_CLOUD_STORAGE,
+                                 SEND_TO_GOOGLE,
+                                 GOOGLE_PROJECT_NAME,
+                                 GOOGLE_STORAGE_COLLECTION)
+
     # All variables must be defined for sending!
     if GOOGLE_CLOUD_STORAGE in [None,""]:
         SEND_TO_GOOGLE = False
@@ -199,6 +230,7 @@ def upload_storage(batch_ids=None):
 
                 # Finish and record time elapsed
                 change_status(batch,"DONE")
+                confirm_instances(batch)
 
             batch.qa['UploadFinishTime'] = time.time()
             total_time = batch.qa['UploadFinishTime'] - batch.qa['UploadStartTime']
@@ -213,6 +245,68 @@ def upload_storage(batch_ids=None):
         return client.batch.runInsert(table)
 
 
+def join_shards(batches):
+    '''join shards returns the batches to upload, with the shards of a batch
+    that was split (see tasks.utils.shard_batch) replaced by the batch. When
+    all shards of a batch are done processing, the images are moved back to
+    the batch, and the identifiers are merged and shared across all of them.
+    '''
+    from .update import get_shared_ids
+
+    joined = []
+    parents = []
+    for batch in batches:
+        if "Parent" not in batch.qa:
+            joined.append(batch)
+        elif batch.qa['Parent'] not in parents:
+            parents.append(batch.qa['Parent'])
+
+    for bid in parents:
+        with transaction.atomic():
+            batch = Batch.objects.select_for_update().get(id=bid)
+            shards = list(Batch.objects.filter(id__in=batch.qa['Shards']))
+            statuses = [x.status for x in shards]
+
+            # Already joined, or waiting for a shard
+            if batch.status != "PROCESSING":
+                continue
+            if len([x for x in statuses if x not in ["DONEPROCESSING","EMPTY","ERROR"]]) > 0:
+                continue
+
+            if "ERROR" in statuses:
+                change_status(batch,"ERROR")
+                message = "a shard of batch %s had an error, stopping upload" %(bid)
+                batch = add_batch_error(message,batch)
+                batch.save()
+                continue
+
+            Image.objects.filter(batch__in=shards).update(batch=batch)
+            batch_ids,created = BatchIdentifiers.objects.get_or_create(batch=batch)
+            ids = dict(batch_ids.ids)
+            updated = dict(batch_ids.updated)
+            cleaned = dict(batch_ids.cleaned)
+            for shard_ids in BatchIdentifiers.objects.filter(batch__in=shards):
+                if len(batch_ids.response) == 0:
+                    batch_ids.response = shard_ids.response
+                ids.update(shard_ids.ids)
+                updated.update(shard_ids.updated)
+                cleaned.update(shard_ids.cleaned)
+            batch_ids.ids = ids
+            batch_ids.updated = updated
+            batch_ids.cleaned = cleaned
+
+            headers = get_header_index(batch.image_set.all(), skip_missing=True)
+            batch_ids.shared = get_shared_ids(list(headers.values()))
+            batch_ids.save()
+
+            batch.qa['ProcessFinishTime'] = max(x.qa.get('ProcessFinishTime',0) for x in shards)
+            change_status(batch,"DONEPROCESSING")
+            change_status(shards,"DONE")
+            joined.append(batch)
+
+    return joined
+
+
 @shared_task
 def clean_up(bid, remove_batch=False):
     '''clean up will check a batch for errors, and if none exist, clear the entries
@@ -24,6 +24,7 @@ SOFTWARE.
 
 from sendit.logger import bot
 from celery import (
+    chain,
     shared_task, 
     Celery
 )
@@ -36,17 +37,29 @@ from sendit.apps.main.models import (
 )
 
 from sendit.apps.main.tasks.utils import (
+    acquire_lease,
     add_batch_error,
     add_batch_warning,
+    bulk_create_images,
     change_status,
     chunks,
-    save_image_dicom
+    get_batch_uid,
+    get_checksum,
+    get_header_fields,
+    get_header_index,
+    rate_limit,
+    read_dicom_header,
+    read_manifest,
+    release_lease,
+    remove_duplicates,
+    shard_batch,
+    stage_dicom,
+    start_heartbeat,
+    with_lease,
+    write_manifest
 )
 
-from deid.dicom import (
-    get_identifiers as get_ids,
-    has_burned_pixels
-)
+from deid.dicom import has_burned_pixels
 from retrying import retry
 
 from som.api.identifiers.dicom import (
@@ -60,16 +73,34 @@ from som.api.identifiers import Client
 from sendit.settings import (
     ANONYMIZE_PIXELS,
     ANONYMIZE_RESTFUL,
+    DASHER_COALESCE_SIZE,
+    DASHER_COALESCE_WINDOW,
+    DASHER_RETRIES,
+    IMPORT_HEADER_ONLY,
+    IMPORT_CHECKSUM,
+    IMPORT_CHUNK_SIZE,
+    IMPORT_HEADER_TAGS,
+    IMPORT_RESUME,
+    IMPORT_SHARD_COUNT,
+    IMPORT_SHARD_SIZE,
+    IMPORT_WORKERS,
+    PIPELINE_SERIES,
     SOM_STUDY,
     STUDY_DEID
 )
 
+from billiard import Pool
 from django.conf import settings
-from sendit.apps.main.utils import ls_fullpath
+from django.db import connections
+from sendit.apps.main.utils import (
+    get_inventory,
+    get_redis
+)
+from collections import OrderedDict
+from functools import partial
 import time
 import os
 
-from pydicom import read_file
 from pydicom.errors import InvalidDicomError
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sendit.settings')
@@ -77,149 +108,313 @@ app = Celery('sendit')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Batches waiting to get identifiers together (see queue_identifiers)
+COALESCE_KEY = "sendit:dasher:pending"
+
 
 # IMPORT ########################################################################
 
 
+def inspect_dicom(dcm_file, batch_id, header_only=True, tags=None, stage=True):
+    '''inspect dicom is run by import_dicomdir for one file, possibly in a
+    worker process. The header is parsed, the image is filtered, and if
+    accepted (and stage is True) the file is staged to the batch folder
+    under MEDIA_ROOT. A dictionary of results is returned to be merged into
+    the batch, and nothing is written to the database here.
+    '''
+    dicom_uid = os.path.basename(dcm_file)
+    result = {'dicom_file': dcm_file,
+              'uid': dicom_uid,
+              'parsed': False,
+              'accept': False,
+              'flagged': None,
+              'error': None}
+
+    try:
+
+        # The dicom folder will be named based on the accession#
+        dcm = read_dicom_header(dcm_file,
+                                header_only=header_only,
+                                tags=tags)
+
+        for field in ['StudyDate','SeriesNumber','SeriesDescription','SOPInstanceUID']:
+            result[field] = dcm.get(field)
+        result['parsed'] = True
+
+        if ANONYMIZE_PIXELS is True:
+            flag, flag_group, reason = has_burned_pixels(dicom_file=dcm_file,
+                                                         quiet=True,
+                                                         deid=STUDY_DEID)
+
+            # If the image is flagged, we don't include and move on
+            continue_processing = True
+            if flag is True:
+                if flag_group not in ["whitelist"]:
+                    continue_processing = False
+                    result['flagged'] = "%s is flagged in %s: %s, skipping" %(dicom_uid, 
+                                                                               flag_group,
+                                                                               reason)
+        else:
+            continue_processing = True
+            if dcm.get('BurnedInAnnotation') is not None:
+                continue_processing = False
+            if "AXIAL" not in dcm.get('ImageType'):
+                continue_processing = False
+
+        if continue_processing is True:
+
+            # Generate image name based on [SUID] added later
+            # accessionnumberSUID.seriesnumber.imagenumber,  
+            result['name'] = "%s_%s.dcm" %(dcm.get('SeriesNumber'),
+                                           dcm.get('InstanceNumber'))
+            result['accept'] = True
+
+            if IMPORT_CHECKSUM is True:
+                result['checksum'] = get_checksum(dcm_file)
+
+            # Index the header, unless only some fields were read
+            result['header'] = dict()
+            if tags is None:
+                result['header']['fields'] = get_header_fields(dcm)
+
+            if stage is True:
+                result = stage_result(result, batch_id=batch_id)
+
+    # Note that on error we don't remove files
+    except InvalidDicomError:
+        result['error'] = "InvalidDicomError: %s skipping." %(dcm_file)
+    except KeyError:
+        result['error'] = "KeyError: %s is possibly invalid, skipping." %(dcm_file)
+    except Exception as e:
+        bot.debug("Exception: %s, for %s, skipping." %(e, dcm_file))
+
+    return result
+
+
+def stage_result(result, batch_id):
+    '''stage result will save the file of an accepted result from
+    inspect_dicom to storage (the batch folder), and add the file size and
+    modified time to its header index entry. If the file can't be staged,
+    the result is not accepted.
+    '''
+    # Staged by an import that was resumed
+    if result.get('resumed') is True:
+        return result
+
+    try:
+        # Save the dicom file to storage, relative to MEDIA_ROOT
+        result['image'] = stage_dicom(dicom_file=result['dicom_file'],
+                                      batch_id=batch_id)
+        if "fields" in result['header']:
+            staged = "%s/%s" %(settings.MEDIA_ROOT, result['image'])
+            stat = os.stat(staged)
+            result['header']['size'] = stat.st_size
+            result['header']['mtime'] = stat.st_mtime_ns
+    except Exception as e:
+        bot.debug("Exception: %s, for %s, skipping." %(e, result['dicom_file']))
+        result['accept'] = False
+    return result
+
+
 @shared_task
+@with_lease(key=lambda dicom_dir, *args, **kwargs: os.path.basename(dicom_dir))
 def import_dicomdir(dicom_dir, run_get_identifiers=True):
     '''import dicom directory manages importing a valid dicom set into 
     the application, and is a celery job triggered by the watcher. 
     Here we also flag (and disclude) images that have a header value 
-    that indicates pixel identifiers.
+    that indicates pixel identifiers. With PIPELINE_SERIES, each series
+    is sent to be de-identified as soon as it is imported.
     '''
     start_time = time.time()
 
     if os.path.exists(dicom_dir):
         try:
-            dicom_files = ls_fullpath(dicom_dir)
+            inventory = [x for x in get_inventory(dicom_dir) if x['is_file']]
         except NotADirectoryError:
             bot.error('%s is not a directory, skipping.' %dicom_dir)
             return
             
+        dicom_files = [x['path'] for x in inventory]
         bot.debug("Importing %s, found %s .dcm files" %(dicom_dir,len(dicom_files)))        
 
         # The batch --> the folder with a set of dicoms tied to one request
         dcm_folder = os.path.basename(dicom_dir)   
         batch,created = Batch.objects.get_or_create(uid=dcm_folder)
+        if "Shards" in batch.qa:
+            bot.warning('%s was split into batches %s, skipping.' %(dicom_dir, batch.qa['Shards']))
+            return
+        if batch.status in ["DONEPROCESSING", "DONE"]:
+            bot.warning('%s was already processed, skipping.' %dicom_dir)
+            return
         batch.logs['STARTING_IMAGE_COUNT'] = len(dicom_files)
 
         # Data quality check: keep a record of study dates
         study_dates = dict()
         series = {}
         all_series = []
-        size_bytes = sum(os.path.getsize(f) for f in dicom_files)
+        size_bytes = sum(x['size'] for x in inventory)
         messages = [] # print all unique messages / warnings at end
 
-        # Add in each dicom file to the series
-        for dcm_file in dicom_files:
-            try:
-
-                # The dicom folder will be named based on the accession#
-                dcm = read_file(dcm_file,force=True)
-                dicom_uid = os.path.basename(dcm_file)
+        # Unless we scrub pixels, we only need to read the header
+        header_only = IMPORT_HEADER_ONLY
+        if header_only is None:
+            header_only = not ANONYMIZE_PIXELS
+
+        # Stream series to de-identification, staged after all are parsed
+        streaming = False
+        if PIPELINE_SERIES is True and ANONYMIZE_RESTFUL is True:
+            streaming = run_get_identifiers
+
+        # Accepted images are staged in the batch folder under MEDIA_ROOT
+        batch_folder = batch.get_path()
+        if not os.path.exists(batch_folder):
+            os.makedirs(batch_folder)
+
+        inspect = partial(inspect_dicom,
+                          batch_id=batch.id,
+                          header_only=header_only,
+                          tags=IMPORT_HEADER_TAGS,
+                          stage=not streaming)
+
+        # Files done by an earlier import of the batch are not done again
+        sizes = dict((x['path'],x['size']) for x in inventory)
+        done = dict()
+        if IMPORT_RESUME is True and created is False:
+            done = read_manifest(batch,sizes)
+            if len(done) > 0:
+                bot.debug("Resuming import of %s, %s files done" %(batch.uid,len(done)))
+        todo = [x for x in dicom_files if x not in done]
+
+        # Parse, filter and stage files, in parallel if IMPORT_WORKERS > 1
+        pool = None
+        if IMPORT_WORKERS > 1 and len(todo) > 1:
+            connections.close_all() # workers must not share the connection
+            pool = Pool(processes=IMPORT_WORKERS)
+            results = pool.imap(inspect, todo, chunksize=8)
+        else:
+            results = map(inspect, todo)
+        results = resume_results(dicom_files, done, results)
+
+        # Merge results in the original file order, images added in chunks
+        accepted = []
+        duplicates = [] # images already imported by another batch
+        unwritten = [] # results to add to the manifest, when images are saved
+        pending = OrderedDict() # accepted and not staged, by series
+        try:
+            for result in results:
+                dcm_file = result['dicom_file']
+                if result.get('resumed') is not True:
+                    result['size'] = sizes[dcm_file]
+                    if streaming is False or result['accept'] is False:
+                        unwritten.append(result)
+                if result['error'] is not None:
+                    batch = add_batch_error(result['error'],batch)
+                if result['parsed'] is False:
+                    continue
+                if result.get('resumed') is True and result.get('duplicate') is not None:
+                    duplicates.append(result)
 
                 # Keep track of studyDate
-                study_date = dcm.get('StudyDate')
-                series_id = dcm.get('SeriesNumber')
+                study_date = result['StudyDate']
+                series_id = result['SeriesNumber']
                 if series_id not in all_series:
                     all_series.append(series_id)
                 if study_date not in study_dates:
                     study_dates[study_date] = 0
                 study_dates[study_date] += 1
 
-                if ANONYMIZE_PIXELS is True:
-                    flag, flag_group, reason = has_burned_pixels(dicom_file=dcm_file,
-                                                                 quiet=True,
-                                                                 deid=STUDY_DEID)
-
-                    # If the image is flagged, we don't include and move on
-                    continue_processing = True
-                    if flag is True:
-                        if flag_group not in ["whitelist"]:
-                            continue_processing = False
-                            message = "%s is flagged in %s: %s, skipping" %(dicom_uid, 
-                                                                            flag_group,
-                                                                            reason)
-                            batch = add_batch_warning(message,batch,quiet=True)
-                            message = "BurnedInAnnotation found for batch %s" %batch.uid
-                            if message not in messages:
-                                messages.append(message)
+                # If the image is flagged, we don't include and move on
+                if result['flagged'] is not None:
+                    batch = add_batch_warning(result['flagged'],batch,quiet=True)
+                    message = "BurnedInAnnotation found for batch %s" %batch.uid
+                    if message not in messages:
+                        messages.append(message)
 
-                else:
-                    continue_processing = True
-                    if dcm.get('BurnedInAnnotation') is not None:
-                        continue_processing = False
-                    if "AXIAL" not in dcm.get('ImageType'):
-                        continue_processing = False
-
-                if continue_processing is True:
-                    # Create the Image object in the database
-                    # A dicom instance number must be unique for its batch
-                    dicom = Image.objects.create(batch=batch,
-                                                 uid=dicom_uid)
+                if result['accept'] is True:
 
                     # Series Number and count of slices (images)
-                    if series_id is not None and series_id not in series:
+                    if series_id not in series:
                         series[series_id] = {'SeriesNumber': series_id,
                                              'Images':1 }
                         # Series Description
-                        description = dcm.get('SeriesDescription')
-                        if dcm.get('SeriesDescription') is not None:
+                        description = result['SeriesDescription']
+                        if description is not None:
                             series[series_id]['SeriesDescription'] = description
                     else:
                         series[series_id]['Images'] +=1
 
-                    # Save the dicom file to storage
-                    # basename = "%s/%s" %(batch.id,os.path.basename(dcm_file))
-                    dicom = save_image_dicom(dicom=dicom,
-                                             dicom_file=dcm_file) # Also saves
-
-                    # Generate image name based on [SUID] added later
-                    # accessionnumberSUID.seriesnumber.imagenumber,  
-                    name = "%s_%s.dcm" %(dcm.get('SeriesNumber'),
-                                         dcm.get('InstanceNumber'))
-                    dicom.name = name
-                    dicom.save()
+                    if streaming is True:
+                        if series_id not in pending:
+                            pending[series_id] = []
+                        pending[series_id].append(result)
+                        continue
+
+                    # Add the Image objects to the database, file is staged
+                    # A dicom instance number must be unique for its batch
+                    accepted.append(result)
+                    if len(accepted) >= IMPORT_CHUNK_SIZE:
+                        duplicates += save_results(batch,accepted)
+                        write_manifest(batch,unwritten)
+                        accepted = []
+                        unwritten = []
                     # Only remove files successfully imported
                     #os.remove(dcm_file)
 
-            # Note that on error we don't remove files
-            except InvalidDicomError:
-                message = "InvalidDicomError: %s skipping." %(dcm_file)
-                batch = add_batch_error(message,batch)
-            except KeyError:
-                message = "KeyError: %s is possibly invalid, skipping." %(dcm_file)
+            if len(accepted) > 0:
+                duplicates += save_results(batch,accepted)
+            write_manifest(batch,unwritten)
+
+            # When streaming, duplicates are removed before series are started
+            for series_id in list(pending.keys()):
+                removed = []
+                for subset in chunks(pending[series_id], IMPORT_CHUNK_SIZE):
+                    removed += remove_duplicates(batch,subset)
+                write_manifest(batch,removed)
+                duplicates += removed
+                pending[series_id] = [x for x in pending[series_id] if x['accept'] is True]
+                if len(pending[series_id]) == 0:
+                    del pending[series_id]
+
+            # Print summary messages all at once
+            for message in messages:
+                bot.warning(message)
+
+            if len(study_dates) > 1:
+                message = "% study dates found for %s" %(len(study_dates),
+                                                         dcm_file)
                 batch = add_batch_error(message,batch)
-            except Exception as e:
-                message = "Exception: %s, for %s, skipping." %(e, dcm_file)
 
-        # Print summary messages all at once
-        for message in messages:
-            bot.warning(message)
-
-        if len(study_dates) > 1:
-            message = "% study dates found for %s" %(len(study_dates),
-                                                     dcm_file)
-            batch = add_batch_error(message,batch)
-
-        # Which series aren't represented with data?
-        removed_series = [x for x in all_series if x not in list(series.keys())]
-
-        # Save batch thus far
-        batch.qa['NumberOfSeries'] = len(series)
-        batch.qa['FlaggedSeries'] = removed_series
-        batch.qa['Series'] = series
-        batch.qa['StudyDate'] = study_dates
-        batch.qa['StartTime'] = start_time
-        batch.qa['SizeBytes'] = size_bytes
-        batch.save()
+            # Which series aren't represented with data?
+            removed_series = [x for x in all_series if x not in list(series.keys())]
+
+            # Save batch thus far
+            batch.qa['NumberOfSeries'] = len(series)
+            batch.qa['FlaggedSeries'] = removed_series
+            batch.qa['Series'] = series
+            batch.qa['StudyDate'] = study_dates
+            batch.qa['StartTime'] = start_time
+            batch.qa['SizeBytes'] = size_bytes
+            batch.qa['Duplicates'] = len(duplicates)
+            batch.qa['DuplicateBytes'] = sum(x['size'] for x in duplicates)
+            batch.qa['ImportFinishTime'] = time.time()
+            if len(duplicates) > 0:
+                batch.logs['DUPLICATES'] = dict((x['uid'],x['duplicate']) for x in duplicates)
+            batch.save()
          
-        # If there were no errors on import, we should remove the directory
-        #if not batch.has_error:
+            # If there were no errors on import, we should remove the directory
+            #if not batch.has_error:
             
-            # Should only be called given no error, and should trigger error if not empty
-            #os.rmdir(dicom_dir)
+                # Should only be called given no error, and should trigger error if not empty
+                #os.rmdir(dicom_dir)
+
+            # Each series is staged, and then de-identified as the next is staged
+            if streaming is True and len(pending) > 0:
+                return start_pipeline(batch, pending, pool=pool)
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         # At the end, submit the dicoms to be anonymized as a batch 
         count = batch.image_set.count()
@@ -232,8 +427,22 @@ def import_dicomdir(dicom_dir, run_get_identifiers=True):
                 # scrub_pixels(bid=batch.id)
             #else:
             if run_get_identifiers is True:
+
+                # A large batch is split by series, and joined for upload
+                shards = shard_batch(batch,
+                                     max_count=IMPORT_SHARD_COUNT,
+                                     max_size=IMPORT_SHARD_SIZE)
+                for shard in shards:
+                    bot.debug("get_identifiers submit shard %s with %s dicoms." %(shard.uid,
+                                                                                  shard.image_set.count()))
+                    deidentify_batch(bid=shard.id)
+                if len(shards) > 0:
+                    change_status(batch,"PROCESSING")
+                    return shards
+
                 bot.debug("get_identifiers submit batch %s with %s dicoms." %(batch.uid,count))
-                return get_identifiers(bid=batch.id)
+                deidentify_batch(bid=batch.id)
+                return batch
             else:
                 bot.debug("Finished batch %s with %s dicoms" %(batch.uid,count))
                 return batch
@@ -250,10 +459,99 @@ def import_dicomdir(dicom_dir, run_get_identifiers=True):
         bot.warning('Cannot find %s' %dicom_dir)
 
 
+def deidentify_batch(bid, run_upload_storage=False):
+    '''deidentify batch submits the de-identification stages for a batch as
+    a chain of tasks, get_identifiers and then replace_identifiers, each
+    routed to its queue (see CELERY_ROUTES) so the import worker is free.
+    With DASHER_COALESCE_SIZE, the batch instead waits to get identifiers
+    with other batches, in one request (see get_identifiers_many).
+    '''
+    if DASHER_COALESCE_SIZE is not None and ANONYMIZE_RESTFUL is True:
+        if run_upload_storage is False:
+            return queue_identifiers(bid)
+
+    stages = chain(get_identifiers.si(bid=bid, run_replace_identifiers=False),
+                   replace_identifiers.si(bid=bid, run_upload_storage=run_upload_storage))
+    return stages.apply_async()
+
+
+def resume_results(dicom_files, done, results):
+    '''resume results will yield a result for each dicom file, in order,
+    from the files done by an earlier import (done) if found, and
+    otherwise from the results of the files still to do.
+    '''
+    for dicom_file in dicom_files:
+        if dicom_file in done:
+            yield done[dicom_file]
+        else:
+            yield next(results)
+
+
+def save_results(batch, results):
+    '''save results will add the images for a chunk of accepted (and staged)
+    results from inspect_dicom to the database, except for images already
+    imported by another batch. The duplicate results are returned.
+    '''
+    duplicates = remove_duplicates(batch,results)
+    images = [get_image(batch,x) for x in results if x['accept'] is True]
+    bulk_create_images(batch,images)
+    return duplicates
+
+
+def get_image(batch, result):
+    '''get image returns an (unsaved) main.Image for a staged result
+    from inspect_dicom, with the file, name and header index set.
+    '''
+    return Image(batch=batch,
+                 uid=result['uid'],
+                 name=result['name'],
+                 image=result['image'],
+                 header=result['header'])
+
+
+def start_pipeline(batch, pending, pool=None):
+    '''start pipeline will stage the images of a batch one series at a time,
+    and start processing (getting identifiers, de-identification) of each
+    series as soon as its images are in the database. The last series to
+    finish processing finishes the batch (see tasks.pipeline).
+    '''
+    from .pipeline import process_series
+
+    stage = partial(stage_result, batch_id=batch.id)
+
+    # All series are known before the first is started
+    batch.status = "PROCESSING"
+    batch.qa['ProcessStartTime'] = time.time()
+    batch.qa['Pipeline'] = {'Series': [str(x) for x in pending],
+                            'Done': []}
+    batch.save()
+    BatchIdentifiers.objects.get_or_create(batch=batch)
+
+    for series_id, results in pending.items():
+        if pool is not None:
+            results = pool.imap(stage, results, chunksize=8)
+        else:
+            results = map(stage, results)
+        results = list(results)
+        images = [get_image(batch,x) for x in results if x['accept'] is True]
+        for subset in chunks(images, IMPORT_CHUNK_SIZE):
+            bulk_create_images(batch,subset)
+        write_manifest(batch,[x for x in results if x.get('resumed') is not True])
+
+        bot.debug("process_series submit series %s of batch %s with %s dicoms." %(series_id,
+                                                                                   batch.uid,
+                                                                                   len(images)))
+        process_series.apply_async(kwargs={"bid": batch.id,
+                                           "series": str(series_id),
+                                           "uids": [x.uid for x in images]})
+    return batch
+
+
 # EXTRACT #######################################################################
 
 
 @shared_task
+@with_lease(key=get_batch_uid)
 def get_identifiers(bid,study=None,run_replace_identifiers=True):
     '''get identifiers is the celery task to get identifiers for 
     all images in a batch. A batch is a set of dicom files that may include
@@ -262,6 +560,9 @@ def get_identifiers(bid,study=None,run_replace_identifiers=True):
     under settings, this function doesn't run
     '''
     batch = Batch.objects.get(id=bid)
+    if batch.status in ["DONEPROCESSING", "DONE"]:
+        bot.warning("Batch %s was already processed, skipping." %(bid))
+        return
 
     if study is None:
         study = SOM_STUDY
@@ -271,19 +572,19 @@ def get_identifiers(bid,study=None,run_replace_identifiers=True):
         images = batch.image_set.all()
 
         # Process all dicoms at once, one call to the API
-        dicom_files = batch.get_image_paths()
         batch.status = "PROCESSING"
         batch.save()
 
         try:
-            ids = get_ids(dicom_files=dicom_files,
-                          expand_sequences=False)  # we are uploading a zip, doesn't make sense
-                                                   # to preserve image level metadata
+            # Headers are read from the index, sequences are not expanded
+            # we are uploading a zip, doesn't make sense to preserve image level metadata
+            ids = get_header_index(images)
         except FileNotFoundError:
             batch.status = "ERROR"
             message = "batch %s is missing dicom files and should be reprocessed" %(batch.id)
             batch = add_batch_warning(message,batch)
             batch.save()
+            return
 
         # Prepare identifiers with only minimal required
         # This function expects many items for one entity, returns 
@@ -327,7 +628,132 @@ def get_identifiers(bid,study=None,run_replace_identifiers=True):
 
 
 
-@retry(stop_max_attempt_number=3)
+def queue_identifiers(bid):
+    '''queue identifiers adds a batch to the list (in redis) of batches waiting
+    to get identifiers. The first batch added submits get_identifiers_many
+    to run after DASHER_COALESCE_WINDOW seconds, and a full list submits
+    it now, so batches added together are sent in one request.
+    '''
+    count = get_redis().rpush(COALESCE_KEY, bid)
+    if count >= DASHER_COALESCE_SIZE:
+        get_identifiers_many.apply_async()
+    elif count == 1:
+        get_identifiers_many.apply_async(countdown=DASHER_COALESCE_WINDOW)
+
+
+def pop_identifiers(size):
+    '''pop up to size batch ids from the list of batches waiting to get
+    identifiers, returning them and the number still waiting'''
+    pipe = get_redis().pipeline()
+    pipe.lrange(COALESCE_KEY, 0, size - 1)
+    pipe.ltrim(COALESCE_KEY, size, -1)
+    pipe.llen(COALESCE_KEY)
+    bids, trimmed, waiting = pipe.execute()
+    return [int(x) for x in bids], waiting
+
+
+@shared_task
+def get_identifiers_many(bids=None, study=None):
+    '''get identifiers many is the celery task to get identifiers for several
+    batches (by default, those waiting, see queue_identifiers) with one
+    request to DASHER. The identifiers of all batches are sent together,
+    and the results are split back to each batch by their order. Each
+    batch is then submitted to replace_identifiers. A batch is leased as
+    by get_identifiers, and skipped if another worker holds its lease.
+    '''
+    if bids is None:
+        bids, waiting = pop_identifiers(DASHER_COALESCE_SIZE)
+        if waiting > 0:
+            get_identifiers_many.apply_async(countdown=DASHER_COALESCE_WINDOW)
+
+    batches = Batch.objects.filter(id__in=bids).exclude(status__in=["DONEPROCESSING","DONE"])
+    leases = []
+    for batch in batches:
+        owner = acquire_lease("get_identifiers", batch.uid)
+        if owner is None:
+            bot.warning("get_identifiers is already running for %s, skipping." %batch.uid)
+            continue
+        leases.append((batch, owner))
+
+    if len(leases) == 0:
+        return
+    heartbeat = start_heartbeat("get_identifiers", [(x.uid, owner) for x, owner in leases])
+    try:
+        return request_identifiers([x for x, owner in leases], study=study)
+    finally:
+        heartbeat.set()
+        for batch, owner in leases:
+            release_lease("get_identifiers", batch.uid, owner)
+
+
+def request_identifiers(batches, study=None):
+    '''request identifiers gets identifiers for a list of batches with one
+    request to DASHER (see get_identifiers_many), and returns the ids of
+    the batches that were sent.
+    '''
+    if study is None:
+        study = SOM_STUDY
+
+    pending = []
+    identifiers = []
+    for batch in batches:
+        batch.status = "PROCESSING"
+        try:
+            ids = get_header_index(batch.image_set.all())
+        except FileNotFoundError:
+            batch.status = "ERROR"
+            message = "batch %s is missing dicom files and should be reprocessed" %(batch.id)
+            batch = add_batch_warning(message,batch)
+            batch.save()
+            continue
+        batch.save()
+        request = prepare_identifiers_request(ids) # force: True
+        pending.append((batch, ids, len(identifiers), len(request['identifiers'])))
+        identifiers += request['identifiers']
+
+    if len(pending) == 0:
+        return
+
+    # One request, with the identifiers of all batches in order
+    request = dict(request, identifiers=identifiers)
+    bot.debug("som.client making request to anonymize %s batches" %(len(pending)))
+    result = None
+    message = None
+    try:
+        result = run_client(study, request)
+    except:
+        message = "error with client, stopping job."
+
+    if result is not None:
+        if "results" not in result:
+            message = "'results' field not found in response: %s" %result
+        elif len(result['results']) != len(identifiers):
+            message = "response has %s results for %s identifiers" %(len(result['results']),
+                                                                   len(identifiers))
+    for batch, ids, start, count in pending:
+        if message is not None:
+            batch = add_batch_error(message,batch)
+            batch.status = "ERROR"
+            batch.qa['FinishTime'] = time.time()
+            batch.save()
+            continue
+
+        batch_ids,created = BatchIdentifiers.objects.get_or_create(batch=batch)
+        batch_ids.response = result['results'][start:start + count]
+        batch_ids.ids = ids
+        batch_ids.save()
+        batch.qa['DasherFinishTime'] = time.time()
+        batch.save()
+        replace_identifiers.apply_async(kwargs={"bid": batch.id})
+    return [batch.id for batch, ids, start, count in pending]
+
+
+@retry(wait_exponential_multiplier=1000,
+       wait_exponential_max=30000,
+       stop_max_attempt_number=DASHER_RETRIES)
 def run_client(study,request):
-    cli = Client(study=study)
-    return cli.deidentify(ids=request, study=study)
+    '''run client sends a request to DASHER, waiting its turn with the
+    other workers (see DASHER_RATE and DASHER_CONCURRENCY in settings)'''
+    with rate_limit("dasher"):
+        cli = Client(study=study)
+        return cli.deidentify(ids=request, study=study)
@@ -0,0 +1,162 @@
+'''
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from celery import (
+    shared_task,
+    Celery
+)
+
+from sendit.logger import bot
+from sendit.apps.main.models import (
+    Batch,
+    BatchIdentifiers
+)
+
+from sendit.apps.main.tasks.utils import (
+    add_batch_error,
+    change_status,
+    get_header_index
+)
+
+from som.api.identifiers.dicom import (
+    prepare_identifiers_request
+)
+
+from .get import run_client
+from .update import (
+    deidentify_images,
+    get_shared_ids,
+    rename_images
+)
+from .finish import upload_storage
+
+from sendit.settings import SOM_STUDY
+
+from django.conf import settings
+from django.db import transaction
+import time
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sendit.settings')
+app = Celery('sendit')
+app.config_from_object('django.conf:settings')
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@shared_task
+def process_series(bid, series, uids, study=None, run_upload_storage=False):
+    '''process series will get identifiers for, and de-identify, the images
+    of one series of a batch. It is started by import_dicomdir (with
+    PIPELINE_SERIES) as soon as the series is imported, so the rest of the
+    batch can still be importing. The batch is shared by the tasks for
+    its series, so it is only changed when locked, at the end.
+    '''
+    batch = Batch.objects.get(id=bid)
+
+    if study is None:
+        study = SOM_STUDY
+
+    images = batch.image_set.filter(uid__in=uids)
+    messages = []
+    updated = dict()
+    cleaned = dict()
+
+    # Headers are read from the index, one call to the API for the series
+    ids = get_header_index(images, skip_missing=True)
+    result = None
+    if len(ids) > 0:
+        request = prepare_identifiers_request(ids) # force: True
+        bot.debug("som.client making request to anonymize series %s of batch %s" %(series,bid))
+        try:
+            result = run_client(study,request)
+        except:
+            messages.append("error with client, stopping job.")
+
+    if result is not None:
+        if "results" in result:
+            updated, cleaned, updated_files = deidentify_images(batch=batch,
+                                                                images=images,
+                                                                response=result['results'],
+                                                                ids=ids)
+            headers = get_header_index(images, save=False, force=True, skip_missing=True)
+            messages += rename_images(images, updated=updated, headers=headers)
+        else:
+            messages.append("'results' field not found in response: %s" %result)
+            result = None
+
+    with transaction.atomic():
+        batch = Batch.objects.select_for_update().get(id=bid)
+        batch_ids = BatchIdentifiers.objects.get(batch=batch)
+
+        # All series are for the same entity and item, keep one response
+        if result is not None:
+            if len(batch_ids.response) == 0:
+                batch_ids.response = result['results']
+            batch_ids.ids.update(ids)
+            batch_ids.updated.update(updated)
+            batch_ids.cleaned.update(cleaned)
+            batch_ids.save()
+        elif len(ids) > 0:
+            batch.status = "ERROR"
+
+        for message in messages:
+            batch = add_batch_error(message,batch)
+
+        if series not in batch.qa['Pipeline']['Done']:
+            batch.qa['Pipeline']['Done'].append(series)
+        batch.save()
+
+        drained = len(batch.qa['Pipeline']['Done']) == len(batch.qa['Pipeline']['Series'])
+
+    # The last series to finish finishes the batch
+    if drained is True:
+        return finish_pipeline(bid=bid, run_upload_storage=run_upload_storage)
+    return batch
+
+
+@shared_task
+def finish_pipeline(bid, run_upload_storage=False):
+    '''finish pipeline is called when all series of a batch have been
+    processed, to get the shared identifiers and finish the batch.
+    '''
+    batch = Batch.objects.get(id=bid)
+    batch_ids = BatchIdentifiers.objects.get(batch=batch)
+    batch.qa['ProcessFinishTime'] = time.time()
+
+    if batch.status == "ERROR":
+        batch.qa['FinishTime'] = time.time()
+        batch.save()
+        return batch
+
+    # Images left are de-identified and renamed, headers are indexed
+    headers = get_header_index(batch.image_set.all(), skip_missing=True)
+    batch_ids.shared = get_shared_ids(list(headers.values()))
+    batch_ids.save()
+
+    change_status(batch,"DONEPROCESSING")
+    batch.save()
+
+    if run_upload_storage is True:
+        upload_storage.apply_async(kwargs={"batch_ids": [bid]})
+    return batch.get_image_paths()
@@ -37,13 +37,16 @@ from sendit.apps.main.models import (
 
 from sendit.apps.main.tasks.utils import (
     add_batch_error,
-    change_status
+    change_status,
+    detach_linked_files,
+    get_batch_uid,
+    get_header_index,
+    get_shared_fields,
+    release_linked_files,
+    with_lease
 )
 
-from deid.dicom import (
-    replace_identifiers as replace_ids,
-    get_shared_identifiers
-)
+from deid.dicom import replace_identifiers as replace_ids
 
 from deid.identifiers import clean_identifiers
 from som.api.identifiers.dicom import prepare_identifiers
@@ -102,6 +105,7 @@ def scrub_pixels(bid):
 
 
 @shared_task
+@with_lease(key=get_batch_uid)
 def replace_identifiers(bid, run_upload_storage=False):
     '''replace identifiers is called from get_identifiers, given that the user
     has asked to anonymize_restful. This function will do the replacement,
@@ -109,12 +113,65 @@ def replace_identifiers(bid, run_upload_storage=False):
     '''
 
     batch = Batch.objects.get(id=bid)
+    if batch.status in ["DONEPROCESSING", "DONE"]:
+        bot.warning("Batch %s was already processed, skipping." %(bid))
+        return
+
+    # In a chain, get_identifiers may have stopped with an error
+    try:
+        batch_ids = BatchIdentifiers.objects.get(batch=batch)
+    except BatchIdentifiers.DoesNotExist:
+        bot.warning("Batch %s has no identifiers, skipping." %(bid))
+        return
+    if batch.status == "ERROR":
+        bot.warning("Batch %s had an error getting identifiers, skipping." %(bid))
+        return
     batch.qa['ProcessStartTime'] = time.time()
-    batch_ids = BatchIdentifiers.objects.get(batch=batch)                  
 
+    # Use response from API to generate new fields, and replace in files
+    images = batch.image_set.all()
+    updated, cleaned, updated_files = deidentify_images(batch=batch,
+                                                        images=images,
+                                                        response=batch_ids.response,
+                                                        ids=batch_ids.ids)
+    # Save progress
+    batch_ids.cleaned = cleaned 
+    batch_ids.updated = updated
+    batch_ids.save()
+
+    # Headers changed, update the index (saved with the rename below)
+    headers = get_header_index(images, save=False, force=True, skip_missing=True)
+
+    # Get shared information
+    updated_names = [os.path.basename(x) for x in updated_files]
+    shared_ids = get_shared_ids([headers[x] for x in updated_names if x in headers])
+    batch_ids.shared = shared_ids
+    batch_ids.save()
+
+    # Rename
+    for message in rename_images(images, updated=updated, headers=headers):
+        batch = add_batch_error(message,batch)
+
+    batch.qa['ProcessFinishTime'] = time.time()
+
+    # We don't get here if the call above failed
+    change_status(batch,"DONEPROCESSING")
+    batch.save()
+
+    if run_upload_storage is True:
+        upload_storage.apply_async(kwargs={"batch_ids": [bid]})
+    updated_files = batch.get_image_paths()
+    return updated_files
+
+
+def deidentify_images(batch, images, response, ids):
+    '''deidentify images will use the response from the API to generate new
+    fields for a set of images of a batch, and replace them in the files.
+    The updated and cleaned identifiers, and updated files, are returned.
+    '''
     # 1) use response from API to generate new fields
-    working = deepcopy(batch_ids.ids)
-    prepared = prepare_identifiers(response=batch_ids.response,
+    working = deepcopy(ids)
+    prepared = prepare_identifiers(response=response,
                                    ids=working)
     updated = deepcopy(prepared)
     # 3) use response from API to anonymize all fields in batch.ids
@@ -125,34 +182,54 @@ def replace_identifiers(bid, run_upload_storage=False):
     cleaned = clean_identifiers(ids=updated,
                                 default="KEEP",
                                 deid=deid)
-    # Save progress
-    batch_ids.cleaned = cleaned 
-    batch_ids.updated = updated
-    batch_ids.save()
 
     # Get updated files
-    dicom_files = batch.get_image_paths()
+    dicom_files = []
+    for dcm in images:
+        try:
+            if os.path.exists(dcm.image.path):
+                dicom_files.append(dcm.image.path)
+        # Image object has no file associated with it
+        except ValueError:
+            pass
     output_folder = batch.get_path()
-    updated_files = replace_ids(dicom_files=dicom_files,
-                                deid=deid,
-                                ids=updated,            # ids[item] lookup
-                                overwrite=True,         # overwrites copied files
-                                output_folder=output_folder,
-                                strip_sequences=True,
-                                remove_private=True)  # force = True
-                                                      # save = True,
-    # Get shared information
+
+    # Files hard linked on import are written as new files, not to /data
+    dicom_files, detached = detach_linked_files(dicom_files, output_folder)
+    try:
+        updated_files = replace_ids(dicom_files=dicom_files,
+                                    deid=deid,
+                                    ids=updated,            # ids[item] lookup
+                                    overwrite=True,         # overwrites copied files
+                                    output_folder=output_folder,
+                                    strip_sequences=True,
+                                    remove_private=True)  # force = True
+                                                          # save = True,
+    finally:
+        release_linked_files(detached)
+
+    return updated, cleaned, updated_files
+
+
+def get_shared_ids(headers):
+    '''get shared ids returns the shared identifiers for the (updated)
+    headers of a batch, to be uploaded as metadata with the images
+    '''
     aggregate = ["BodyPartExamined", "Modality", "StudyDescription"]
-    shared_ids = get_shared_identifiers(dicom_files=updated_files, 
-                                        aggregate=aggregate)
-    batch_ids.shared = shared_ids
-    batch_ids.save()
+    return get_shared_fields(headers=headers, 
+                             aggregate=aggregate)
 
-    # Rename
-    for dcm in batch.image_set.all():
+
+def rename_images(images, updated, headers):
+    '''rename images will rename de-identified images based on the suid,
+    and delete images that we don't have (or can't read) identifiers for.
+    A list of error messages is returned, to add to the batch.
+    '''
+    messages = []
+    for dcm in images:
         item_id = os.path.basename(dcm.image.path)
         try:
-            dicom = dcm.load_dicom()
+            headers[item_id] # file read error if not indexed
             # S6M0<MRN-SUID>_<JITTERED-REPORT-DATE>_<ACCESSIONNUMBER-SUID>
             # Rename the dicom based on suid
             if item_id in updated:
@@ -162,21 +239,10 @@ def replace_identifiers(bid, run_upload_storage=False):
             # If we don't have the id, don't risk uploading
             else:
                 message = "%s for Image Id %s file read error: skipping." %(item_id, dcm.id)
-                batch = add_batch_error(message,batch)                
+                messages.append(message)
                 dcm.delete()
         except:
             message = "%s for Image Id %s not found in lookup: skipping." %(item_id, dcm.id)
-            batch = add_batch_error(message,batch)                
+            messages.append(message)
             dcm.delete()
-
-    batch.qa['ProcessFinishTime'] = time.time()
-
-    # We don't get here if the call above failed
-    change_status(batch,"DONEPROCESSING")
-    batch.save()
-
-    if run_upload_storage is True:
-        return upload_storage(batch_ids=[bid])
-    else:
-        updated_files = batch.get_image_paths()
-        return updated_files
+    return messages
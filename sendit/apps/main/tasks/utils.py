@@ -22,25 +22,53 @@ SOFTWARE.
 
 '''
 
-from django.core.files import File
 from sendit.logger import bot
 from sendit.apps.main.models import (
     Batch,
     BatchIdentifiers,
-    Image
+    Image,
+    Instance,
+    Lease
 )
 
 from sendit.settings import (
+    DASHER_BURST,
+    DASHER_CONCURRENCY,
+    DASHER_RATE,
     GOOGLE_STORAGE_COLLECTION,
     ENTITY_ID,
-    ITEM_ID
+    IMPORT_DUPLICATES,
+    IMPORT_STAGING,
+    ITEM_ID,
+    TASK_LEASE_SECONDS
 )
 
+from celery import current_task
 from django.conf import settings
+from django.db import (
+    IntegrityError,
+    connection,
+    transaction
+)
+from django.utils import timezone
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import wraps
+from pydicom import read_file
 import uuid
+import fcntl
+import hashlib
+import json
+import shutil
 import tarfile
+import tempfile
+import threading
+import time
 import os
 
+# ioctl to clone a file on a copy on write filesystem
+FICLONE = 0x40049409
+
 
 def chunks(l, n):
     '''Yield successive n-sized chunks from l.'''
@@ -50,28 +78,357 @@ def chunks(l, n):
 
 ### FILES ##############################################################
 
+# Header fields that import_dicomdir needs, always read
+IMPORT_FIELDS = ['BurnedInAnnotation',
+                 'ImageType',
+                 'InstanceNumber',
+                 'SOPInstanceUID',
+                 'SeriesDescription',
+                 'SeriesNumber',
+                 'StudyDate']
+
+
+def read_dicom_header(dicom_file,header_only=True,tags=None):
+    '''read dicom header will read a dicom file for import. If header_only
+    is True, reading stops before PixelData, and if a list of tags is
+    provided, only those fields (and the ones needed for import) are read.
+    :param dicom_file: the dicom file (usually in /data) to read
+    :param header_only: if True, don't load pixel data (default True)
+    :param tags: an optional list of header fields to read
+    '''
+    if tags is not None:
+        tags = sorted(set(list(tags) + IMPORT_FIELDS))
+    return read_file(dicom_file,
+                     force=True,
+                     stop_before_pixels=header_only,
+                     specific_tags=tags)
+
+
 def save_image_dicom(dicom,dicom_file,basename=None):
     '''save image dicom will save a dicom file to django's media
     storage, for this application defined under /images.
     :param dicom: the main.Image instance 
     :param dicom_file: the dicom file (usually in /data) to save
     '''
+    dicom.image.name = stage_dicom(dicom_file=dicom_file,
+                                   batch_id=dicom.batch.id,
+                                   basename=basename)
+    dicom.save()
+    return dicom
+
+
+# Header fields not kept in the header index (as for deid)
+HEADER_SKIP = ['PixelData',
+               'RedPaletteColorLookupTableData',
+               'GreenPaletteColorLookupTableData',
+               'BluePaletteColorLookupTableData',
+               'VOILUTSequence']
+
+
+def get_header_fields(dcm,skip=None):
+    '''get header fields will return a dictionary of (non empty) fields
+    from a dicom header, the same as deid.dicom.get_identifiers for one
+    file (without expanding sequences).
+    '''
+    if skip is None:
+        skip = HEADER_SKIP
+    fields = dict()
+    for field in dcm.dir():
+        if field in skip:
+            continue
+        try:
+            value = dcm.get(field)
+            if value not in [None,""]:
+                if isinstance(value,bytes):
+                    value = value.decode('utf-8')
+                fields[field] = str(value)
+        except:
+            pass
+    return fields
+
+
+def get_header_entry(dicom_file,dcm=None):
+    '''get header entry will return the header index entry for a dicom file,
+    the header fields along with the size and modified time of the file, to
+    know if the file changed. If dcm is None, the header is read from file.
+    '''
+    if dcm is None:
+        dcm = read_dicom_header(dicom_file)
+    stat = os.stat(dicom_file)
+    return {'fields': get_header_fields(dcm),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns}
+
+
+def get_header_index(images,save=True,force=False,skip_missing=False):
+    '''get header index will return header fields for a set of main.Image,
+    in a lookup by file basename (the item id used by deid). The index is
+    built on import, and a header is only read again if the file changed
+    since, or if force is True (eg, just after the file was rewritten, the
+    size and time may not change). Updated entries are saved to the image
+    if save is True. A missing file raises FileNotFoundError, unless
+    skip_missing is True. Images without a file, or with a file that can't
+    be read, are not included.
+    '''
+    index = dict()
+    for dcm in images:
+        try:
+            dicom_file = dcm.image.path
+        except ValueError:
+            continue
+        try:
+            stat = os.stat(dicom_file)
+        except FileNotFoundError:
+            if skip_missing is True:
+                continue
+            raise
+
+        entry = dcm.header
+        if force is True or entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime_ns:
+            try:
+                entry = get_header_entry(dicom_file)
+            except Exception as e:
+                bot.warning("Cannot read header of %s: %s" %(dicom_file, e))
+                continue
+            dcm.header = entry
+            if save is True:
+                dcm.save()
+
+        index[os.path.basename(dicom_file)] = entry['fields']
+    return index
+
+
+def get_shared_fields(headers,aggregate=None):
+    '''get shared fields will return the fields that are the same across a
+    set of headers (the values of a header index), the same as
+    deid.dicom.get_shared_identifiers. Fields in aggregate are kept as a
+    list of unique values (or one value, if only one is found).
+    '''
+    if aggregate is None:
+        aggregate = []
+    shared = dict()
+    removed = set()
+    for fields in headers:
+        for key,val in fields.items():
+            if key in removed:
+                continue
+            if key in shared:
+                if key in aggregate:
+                    if val not in shared[key]:
+                        shared[key].append(val)
+                elif shared[key] != val:
+                    del shared[key]
+                    removed.add(key)
+            else:
+                if key in aggregate:
+                    val = [val]
+                shared[key] = val
+
+    # For any aggregates that are one item, unwrap again
+    for field in aggregate:
+        if field in shared:
+            if len(shared[field]) == 1:
+                shared[field] = shared[field][0]
+    return shared
+
+
+def stage_dicom(dicom_file,batch_id,basename=None,backend=None):
+    '''stage dicom will put a dicom file into the batch folder of django's
+    media storage, without a database write. The name relative to MEDIA_ROOT
+    is returned, to be set as the (already saved) file of an main.Image
+    :param dicom_file: the dicom file (usually in /data) to stage
+    :param batch_id: the id of the batch (folder) to stage to
+    :param backend: one of auto, hardlink, reflink, or copy. If None,
+                    uses IMPORT_STAGING in settings.
+    '''
     if basename is None:
         basename = os.path.basename(dicom_file)
-    fullpath = "%s/%s" %(settings.MEDIA_ROOT,
-                         basename)
+    if backend is None:
+        backend = IMPORT_STAGING
+    name = "%s/%s" %(batch_id, basename)
+    fullpath = "%s/%s" %(settings.MEDIA_ROOT, name)
 
     folder = os.path.dirname(fullpath)
     if not os.path.exists(folder):
-        os.mkdir(folder)
+        os.makedirs(folder, exist_ok=True)
 
+    # A file left by an earlier import is replaced
+    if os.path.lexists(fullpath):
+        os.remove(fullpath)
+
+    if backend in ["auto","hardlink"]:
+        if link_file(dicom_file, fullpath) is True:
+            return name
+    if backend in ["auto","reflink"]:
+        if reflink_file(dicom_file, fullpath) is True:
+            return name
+    copy_file(dicom_file, fullpath)
+    return name
+
+
+def link_file(source,destination):
+    '''link file will hard link source to destination, if both are on the
+    same filesystem (and mount). Returns True if linked.
+    '''
+    folder = os.path.dirname(destination)
+    if os.stat(source).st_dev != os.stat(folder).st_dev:
+        return False
+    try:
+        os.link(source, destination)
+    except OSError:
+        return False
+    return True
+
+
+def reflink_file(source,destination):
+    '''reflink file will clone source to destination, sharing blocks on a
+    copy on write filesystem (eg, btrfs or xfs). Returns True if cloned.
+    '''
+    with open(source,'rb') as src:
+        with open(destination,'wb') as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                return True
+            except OSError:
+                pass
+    os.remove(destination)
+    return False
+
+
+def copy_file(source,destination):
+    '''copy file will copy source to destination in the kernel, with
+    copy_file_range (python 3.8+), or sendfile, and only falls back to
+    copying through python if neither is supported.
+    '''
+    with open(source,'rb') as src:
+        with open(destination,'wb') as dest:
+            remaining = os.fstat(src.fileno()).st_size
+            for copy_range in [_copy_file_range, _sendfile]:
+                try:
+                    remaining = copy_range(src, dest, remaining)
+                except OSError:
+                    pass
+                if remaining == 0:
+                    return
+            shutil.copyfileobj(src, dest)
+
+
+def _copy_file_range(src,dest,remaining):
+    if not hasattr(os, 'copy_file_range'):
+        return remaining
+    while remaining > 0:
+        copied = os.copy_file_range(src.fileno(), dest.fileno(), remaining)
+        if copied == 0:
+            break
+        remaining -= copied
+    return remaining
+
+
+def _sendfile(src,dest,remaining):
+    offset = src.tell()
+    while remaining > 0:
+        copied = os.sendfile(dest.fileno(), src.fileno(), offset, remaining)
+        if copied == 0:
+            break
+        offset += copied
+        remaining -= copied
+    src.seek(offset)
+    return remaining
+
+
+def detach_linked_files(dicom_files,folder):
+    '''detach linked files will move staged dicom files that are hard links
+    (to the original in /data) into a hidden folder, so that writing a file
+    back to the folder (eg, to replace identifiers) creates a new file, and
+    does not change the original. Each call has its own hidden folder, so
+    tasks for different series of a batch don't share one. The list of paths
+    to read, and of files detached, are returned, and release_linked_files
+    should be called with the second after writing.
+    '''
+    linked_folder = None
+    paths = []
+    detached = []
+    for dicom_file in dicom_files:
+        if os.stat(dicom_file).st_nlink > 1:
+            if linked_folder is None:
+                linked_folder = tempfile.mkdtemp(prefix='.linked', dir=folder)
+            linked = "%s/%s" %(linked_folder,
+                               os.path.basename(dicom_file))
+            os.rename(dicom_file, linked)
+            detached.append((linked, dicom_file))
+            dicom_file = linked
+        paths.append(dicom_file)
+    return paths, detached
+
+
+def release_linked_files(detached):
+    '''release linked files will remove the links detached by one call of
+    detach_linked_files, and move back any file that was not written again.
+    '''
+    folders = set()
+    for linked, dicom_file in detached:
+        if os.path.exists(dicom_file):
+            os.remove(linked)
+        else:
+            os.rename(linked, dicom_file)
+        folders.add(os.path.dirname(linked))
+    for linked_folder in folders:
+        os.rmdir(linked_folder)
+
+
+def get_checksum(dicom_file,block_size=1048576):
+    '''get checksum returns the md5 of a file, read in blocks'''
+    md5 = hashlib.md5()
     with open(dicom_file,'rb') as filey:
-              django_file = File(filey)
-              dicom.image.save(basename,
-                               django_file,
-                               save=True)  
-    dicom.save()
-    return dicom
+        for block in iter(lambda: filey.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_manifest(batch):
+    '''get manifest returns the path of the import manifest for a batch'''
+    return "%s/.manifest" %batch.get_path()
+
+
+def read_manifest(batch,sizes):
+    '''read manifest will return the files of a batch already imported, in a
+    lookup by (source) dicom file, with the result saved by import_dicomdir.
+    Only files that are unchanged in size (sizes is a lookup by file) and
+    that are still staged (if accepted) are returned. The checksum (with
+    IMPORT_CHECKSUM) is kept for duplicates, and not checked here.
+    '''
+    manifest = get_manifest(batch)
+    done = dict()
+    if not os.path.exists(manifest):
+        return done
+    with open(manifest,'r') as filey:
+        for line in filey:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue # partial line, written when the worker died
+            if result.get('size') != sizes.get(result['dicom_file']):
+                continue
+            if result['accept'] is True:
+                staged = "%s/%s" %(settings.MEDIA_ROOT, result['image'])
+                if not os.path.exists(staged):
+                    continue
+            result['resumed'] = True
+            done[result['dicom_file']] = result
+    return done
+
+
+def write_manifest(batch,results):
+    '''write manifest will add import results for files of a batch to its
+    manifest. It should only be called when the images are saved.
+    '''
+    if len(results) == 0:
+        return
+    with open(get_manifest(batch),'a') as filey:
+        for result in results:
+            filey.write("%s\n" %json.dumps(result, default=str))
+        filey.flush()
+        os.fsync(filey.fileno())
 
 
 def generate_compressed_file(files, filename=None, mode="w:gz", archive_basename=None):
@@ -116,6 +473,425 @@ def add_batch_message(message,batch,func,quiet=False):
     batch.save()
     return batch  
 
+def bulk_create_images(batch,images):
+    '''bulk create will insert a chunk of (unsaved) main.Image instances,
+    with file and name already set, for a batch in one query. Images already
+    in the batch (for the unique uid and batch) are skipped.
+    '''
+    uids = [image.uid for image in images]
+    existing = Image.objects.filter(batch=batch,
+                                    uid__in=uids).values_list('uid',flat=True)
+    existing = set(existing)
+    images = [image for image in images if image.uid not in existing]
+    try:
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+
+    # Another worker inserted one or more of the same images
+    except IntegrityError:
+        for image in images:
+            Image.objects.get_or_create(batch=batch,
+                                        uid=image.uid,
+                                        defaults={'name':image.name,
+                                                  'image':image.image.name})
+    return images
+
+
+def remove_duplicates(batch,results):
+    '''remove duplicates will find the images in a chunk of accepted results
+    from import (inspect_dicom) that were already uploaded by another batch,
+    with the same SOPInstanceUID and checksum. Duplicates are no longer
+    accepted (and the staged file is removed) with the id of the batch
+    of the original kept in the result. New images are added to the index
+    (main.Instance), confirmed when uploaded (see confirm_instances), and
+    the duplicate results are returned. An image imported by a batch that
+    was not uploaded (eg, with an error) is taken over by this batch.
+    '''
+    if IMPORT_DUPLICATES != "skip":
+        return []
+
+    results = [x for x in results if x.get('checksum') is not None 
+                                  and x.get('SOPInstanceUID') is not None]
+    uids = [str(x['SOPInstanceUID']) for x in results]
+    instances = Instance.objects.filter(uid__in=uids).select_related('batch')
+    seen = dict(((x.uid,x.checksum),x) for x in instances)
+
+    duplicates = []
+    new = []
+    for result in results:
+        key = (str(result['SOPInstanceUID']), result['checksum'])
+        instance = seen.get(key)
+        if instance is None:
+            seen[key] = Instance(uid=key[0],
+                                 checksum=key[1],
+                                 size=result.get('size',0),
+                                 batch=batch)
+            new.append(seen[key])
+
+        # This batch (if resumed), or another still in flight, imports it
+        elif instance.batch_id == batch.id:
+            continue
+        elif instance.confirmed is False:
+            if instance.batch is None or instance.batch.status in ["DONE","EMPTY","ERROR"]:
+                Instance.objects.filter(id=instance.id,
+                                        confirmed=False).update(batch=batch)
+                instance.batch = batch
+
+        # Uploaded by an earlier batch
+        else:
+            result['accept'] = False
+            result['duplicate'] = instance.batch_id
+            if result.get('image') is not None:
+                staged = "%s/%s" %(settings.MEDIA_ROOT, result['image'])
+                if os.path.exists(staged):
+                    os.remove(staged)
+            duplicates.append(result)
+
+    try:
+        with transaction.atomic():
+            Instance.objects.bulk_create(new)
+
+    # Another worker indexed one or more of the same images
+    except IntegrityError:
+        for instance in new:
+            Instance.objects.get_or_create(uid=instance.uid,
+                                           checksum=instance.checksum,
+                                           defaults={'size':instance.size,
+                                                     'batch':batch})
+    return duplicates
+
+
+def confirm_instances(batch,chunk_size=1000):
+    '''confirm instances marks the images of a batch in the index (main.Instance)
+    as uploaded, so the same image sent again is skipped. Images that were
+    removed before upload (eg, without identifiers) are not confirmed.
+    '''
+    instances = Instance.objects.filter(batch=batch, confirmed=False)
+    batch_ids = BatchIdentifiers.objects.filter(batch=batch).first()
+    if batch_ids is None or len(batch_ids.ids) == 0:
+        return instances.update(confirmed=True)
+
+    # Images with updated identifiers were renamed and uploaded
+    uids = [batch_ids.ids[x].get('SOPInstanceUID') for x in batch_ids.updated
+            if x in batch_ids.ids]
+    uids = [str(x) for x in uids if x is not None]
+    confirmed = 0
+    for subset in chunks(uids, chunk_size):
+        confirmed += instances.filter(uid__in=subset).update(confirmed=True)
+    return confirmed
+
+
+def shard_batch(batch,max_count=None,max_size=None):
+    '''shard batch will split a batch with more images than max_count, or
+    more bytes than max_size, into sub-batches (shards) of whole series, to
+    be processed in parallel. Series are packed (largest first) into as few
+    shards as fit under both, and a series over either is a shard of its
+    own. Images are moved to the folder of their shard, and the list of
+    shards is returned (empty if the batch is not split). The series and
+    size of an image without a header index (eg, with IMPORT_HEADER_TAGS)
+    are from its name (given on import) and its file.
+    '''
+    def is_over(count,size):
+        if max_count is not None and count > max_count:
+            return True
+        return max_size is not None and size > max_size
+
+    series = dict()
+    for image in batch.image_set.all():
+        if 'fields' in image.header:
+            series_id = str(image.header['fields'].get('SeriesNumber'))
+        else:
+            series_id = image.name.split('_')[0]
+        size = image.header.get('size')
+        if size is None:
+            try:
+                size = os.path.getsize(image.image.path)
+            except (OSError, ValueError):
+                size = 0
+        if series_id not in series:
+            series[series_id] = {'count':0, 'size':0, 'images':[]}
+        series[series_id]['count'] += 1
+        series[series_id]['size'] += size
+        series[series_id]['images'].append(image)
+
+    count = sum(x['count'] for x in series.values())
+    size = sum(x['size'] for x in series.values())
+    if len(series) < 2 or not is_over(count,size):
+        return []
+
+    bins = []
+    for series_id in sorted(series, key=lambda x: series[x]['size'], reverse=True):
+        current = series[series_id]
+        for packed in bins:
+            if not is_over(packed['count'] + current['count'],
+                           packed['size'] + current['size']):
+                break
+        else:
+            packed = {'count':0, 'size':0, 'series':[], 'images':[]}
+            bins.append(packed)
+        packed['count'] += current['count']
+        packed['size'] += current['size']
+        packed['series'].append(series_id)
+        packed['images'] += current['images']
+
+    if len(bins) < 2:
+        return []
+
+    shards = []
+    for number,packed in enumerate(bins):
+
+        # A shard is named for the folder, and can't be found by the watcher
+        shard,created = Batch.objects.get_or_create(uid="%s/%s" %(batch.uid,number+1))
+        shard.qa['Parent'] = batch.id
+        shard.qa['Series'] = packed['series']
+        shard.qa['StartTime'] = batch.qa.get('StartTime')
+        shard.qa['SizeBytes'] = packed['size']
+        shard.logs['STARTING_IMAGE_COUNT'] = packed['count']
+        shard.save()
+
+        shard_folder = shard.get_path()
+        if not os.path.exists(shard_folder):
+            os.makedirs(shard_folder)
+
+        # Renamed on the same filesystem, links and the header index are kept
+        with transaction.atomic():
+            for image in packed['images']:
+                name = "%s/%s" %(shard.id, os.path.basename(image.image.name))
+                os.rename(image.image.path, "%s/%s" %(settings.MEDIA_ROOT,name))
+                image.image.name = name
+                image.batch = shard
+                image.save()
+        shards.append(shard)
+
+    batch.qa['Shards'] = [x.id for x in shards]
+    batch.save()
+    return shards
+
+
+def acquire_lease(name,key,timeout=None):
+    '''acquire lease will take the lease for a task (name) to work on a batch
+    (key, the batch uid) for timeout seconds, if it isn't held by another
+    worker (or has expired). The owner of the lease (to release it) is
+    returned, or None if the lease is held.
+    '''
+    if timeout is None:
+        timeout = TASK_LEASE_SECONDS
+    owner = str(uuid.uuid4())
+    now = timezone.now()
+    expires = now + timedelta(seconds=timeout)
+
+    # Take an expired lease, only one worker can update the row
+    taken = Lease.objects.filter(name=name,
+                                 key=key,
+                                 expires__lt=now).update(owner=owner,
+                                                         expires=expires)
+    if taken == 0:
+        try:
+            with transaction.atomic():
+                Lease.objects.create(name=name,
+                                     key=key,
+                                     owner=owner,
+                                     expires=expires)
+        except IntegrityError:
+            return None
+    return owner
+
+
+def release_lease(name,key,owner):
+    '''release lease will remove a lease, if it is still held by the owner'''
+    Lease.objects.filter(name=name,key=key,owner=owner).delete()
+
+
+def renew_lease(name,key,owner,timeout=None):
+    '''renew lease will extend a lease held by the owner for timeout seconds,
+    and return False if it is no longer held'''
+    if timeout is None:
+        timeout = TASK_LEASE_SECONDS
+    expires = timezone.now() + timedelta(seconds=timeout)
+    return Lease.objects.filter(name=name,
+                                key=key,
+                                owner=owner).update(expires=expires) > 0
+
+
+def start_heartbeat(name,leases,timeout=None):
+    '''start heartbeat will renew leases (a list of (key, owner)) for a task
+    from a thread, every third of the timeout, so a lease held by a worker
+    that is running never expires, and one left by a worker that died
+    expires soon. Set the returned event to stop the heartbeat.
+    '''
+    if timeout is None:
+        timeout = TASK_LEASE_SECONDS
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(timeout / 3.0):
+                for key, owner in leases:
+                    try:
+                        if not renew_lease(name, key, owner, timeout):
+                            bot.warning("Lease of %s for %s was lost." %(name, key))
+                    except Exception as e:
+                        bot.warning("Cannot renew lease of %s for %s: %s" %(name, key, e))
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    return stopped
+
+
+def with_lease(key):
+    '''with lease is a decorator for a task working on one batch, so that
+    the task is not run while another worker holds the lease for the batch.
+    key is a function that returns the batch uid from the arguments of the
+    task. The lease is renewed while the task runs (see start_heartbeat).
+    A task submitted to celery is retried after the lease would expire,
+    and one called from another task returns None.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            uid = key(*args, **kwargs)
+            owner = acquire_lease(func.__name__, uid)
+            if owner is None:
+                bot.warning("%s is already running for %s, skipping." %(func.__name__, uid))
+                if current_task and current_task.name.endswith(".%s" %func.__name__):
+                    if not current_task.request.called_directly:
+                        raise current_task.retry(countdown=TASK_LEASE_SECONDS)
+                return
+            heartbeat = start_heartbeat(func.__name__, [(uid, owner)])
+            try:
+                return func(*args, **kwargs)
+            finally:
+                heartbeat.set()
+                release_lease(func.__name__, uid, owner)
+        return wrapper
+    return decorator
+
+
+def get_batch_uid(bid, *args, **kwargs):
+    '''get batch uid returns the uid of a batch from its id, the lease key
+    for a task (see with_lease) that takes the batch id (bid).
+    '''
+    return Batch.objects.get(id=bid).uid
+
+
+# A token bucket shared by all workers (in redis). The bucket is refilled at rate
+# tokens per second up to burst, and a token is taken if there is one. Returns
+# the seconds to wait for the next token (0 if taken). The time is given by the
+# caller, redis 2.8 can't write after reading the time in a script.
+TOKEN_BUCKET = """
+local tokens = tonumber(redis.call('hget', KEYS[1], 'tokens'))
+local stamp = tonumber(redis.call('hget', KEYS[1], 'stamp'))
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+if tokens == nil then
+    tokens = burst
+    stamp = now
+end
+tokens = math.min(burst, tokens + math.max(now - stamp, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(math.max(now, stamp)))
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+# A slot for a call in flight, if there are fewer than the limit (KEYS[2]).
+# Slots are kept (with the time they expire) in a sorted set, so the slot of
+# a worker that died is freed
+ACQUIRE_SLOT = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+local limit = tonumber(redis.call('get', KEYS[2]) or ARGV[4])
+if redis.call('zcard', KEYS[1]) < math.floor(limit) then
+    redis.call('zadd', KEYS[1], ARGV[3], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# The limit of calls in flight is increased by one for each limit calls that
+# succeed, and halved when one fails (additive increase, multiplicative decrease)
+UPDATE_LIMIT = """
+local limit = tonumber(redis.call('get', KEYS[1]) or ARGV[2])
+if ARGV[1] == '1' then
+    limit = math.min(tonumber(ARGV[2]), limit + 1 / limit)
+else
+    limit = math.max(1, limit / 2)
+end
+redis.call('set', KEYS[1], tostring(limit))
+return tostring(limit)
+"""
+
+
+def wait_for_token(name,rate,burst,client=None):
+    '''wait for token will take a token from the bucket for name (shared
+    by all workers), waiting until there is one.
+    '''
+    from sendit.apps.main.utils import get_redis
+    if client is None:
+        client = get_redis()
+    take_token = client.register_script(TOKEN_BUCKET)
+    key = "sendit:ratelimit:%s:tokens" %name
+    while True:
+        wait = float(take_token(keys=[key], args=[rate, burst, time.time()]))
+        if wait <= 0:
+            return
+        time.sleep(wait)
+
+
+@contextmanager
+def rate_limit(name,rate=None,burst=None,concurrency=None,timeout=600):
+    '''rate limit is a context manager for a call to a service (eg, DASHER),
+    shared by all workers with redis. The call waits for a token from a
+    bucket with rate tokens per second (up to burst), and for a slot, with
+    up to concurrency calls in flight. The number of slots is adapted,
+    halved when a call fails and growing back as calls succeed, so the
+    service is not sent more calls than it can take. A slot is freed
+    after timeout seconds if not released (eg, the worker died).
+    '''
+    from sendit.apps.main.utils import get_redis
+    if rate is None:
+        rate = DASHER_RATE
+    if burst is None:
+        burst = DASHER_BURST
+    if concurrency is None:
+        concurrency = DASHER_CONCURRENCY
+    if rate is None and concurrency is None:
+        yield
+        return
+
+    client = get_redis()
+    if rate is not None:
+        wait_for_token(name, rate=rate, burst=burst, client=client)
+    if concurrency is None:
+        yield
+        return
+
+    slots = "sendit:ratelimit:%s:slots" %name
+    limit = "sendit:ratelimit:%s:limit" %name
+    owner = str(uuid.uuid4())
+    acquire_slot = client.register_script(ACQUIRE_SLOT)
+    update_limit = client.register_script(UPDATE_LIMIT)
+    while not acquire_slot(keys=[slots, limit],
+                           args=[time.time(), owner, time.time() + timeout, concurrency]):
+        time.sleep(0.2)
+
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        client.zrem(slots, owner)
+        update_limit(keys=[limit], args=[int(success), concurrency])
+
+
 def add_batch_warning(message,batch,quiet=False):
     return add_batch_message(message=message,
                              batch=batch,
@@ -23,23 +23,42 @@ SOFTWARE.
 '''
 
 from django.core.files import File
+from django.db import (
+    IntegrityError,
+    transaction
+)
 from django.http.response import Http404
 from sendit.settings import (
+    CELERY_QUEUES,
     DATA_BASE,
     DATA_SUBFOLDER,
-    DATA_INPUT_FOLDERS
+    DATA_INPUT_FOLDERS,
+    QUEUE_CHECKPOINTS,
+    QUEUE_HIGH_WATER,
+    QUEUE_LOW_WATER,
+    REDIS_DB,
+    REDIS_HOST,
+    REDIS_PORT
 )
 from sendit.apps.main.models import (
     Image,
     Batch
 )
 
+from itertools import islice
 import time
 from sendit.logger import bot
+import json
 import sys
 import re
 import os
 
+# os.scandir is python 3.5+, the scandir package provides it before
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 
 #### GETS #############################################################
 
@@ -79,9 +98,40 @@ def get_database():
 
 def ls_fullpath(dirname,ext=None):
     '''get full path of all files in a directory'''
-    if ext is not None:
-        return [os.path.join(dirname, f) for f in os.listdir(dirname) if f.endswith(ext)]
-    return [os.path.join(dirname, f) for f in os.listdir(dirname)]
+    return [x['path'] for x in get_inventory(dirname,ext=ext,stat=False)]
+
+
+def get_inventory(dirname,ext=None,stat=True):
+    '''get inventory will read a directory once (with os.scandir) and return
+    a list of entries, each a dictionary with the full path, name, type
+    (is_dir, is_file), and if stat is True, the size and modified time.
+    The type is known from the directory read alone, so use stat=False
+    if the size and time aren't needed. Entries that are removed while
+    reading the directory are skipped.
+    '''
+    entries = []
+    for entry in scandir(dirname):
+        if ext is not None and not entry.name.endswith(ext):
+            continue
+        try:
+            item = {'path': entry.path,
+                    'name': entry.name,
+                    'is_dir': entry.is_dir(),
+                    'is_file': entry.is_file()}
+            if stat is True:
+                info = entry.stat()
+                item['size'] = info.st_size
+                item['mtime'] = info.st_mtime
+        except FileNotFoundError:
+            continue
+        entries.append(item)
+    return entries
+
+
+def get_inventory_size(dirname):
+    '''get inventory size returns the total size (in bytes) of the files
+    in a directory, from one read of the directory'''
+    return sum(x['size'] for x in get_inventory(dirname) if x['is_file'])
 
 
 
@@ -89,12 +139,14 @@ def ls_fullpath(dirname,ext=None):
 
 #### WORKER ##########################################################
 
-def update_cached(subfolder=None):
+def update_cached(subfolder=None, chunk_size=1000):
     '''
     update the queue (batch object with status QUEUE), intended to be
     run when there are new folders to find and queue.
     First preference goes to a folder supplied to the function, then
     to application defaults. We return None if the result is None.
+    Date folders that have not changed since the last check (see
+    QUEUE_CHECKPOINTS) are skipped.
     '''
     CHECK_FOLDERS = None    
 
@@ -118,27 +170,151 @@ def update_cached(subfolder=None):
     if not isinstance(CHECK_FOLDERS,list):
         CHECK_FOLDERS = [CHECK_FOLDERS]
 
+    checkpoints = load_checkpoints()
     count = 0
-    current = [x.uid for x in Batch.objects.all()]
     for base in CHECK_FOLDERS:
         print('Checking base %s' %base)
-        if os.path.exists(base) and os.path.isdir(base):
-            # If it's not a date
-            if not re.search('[0-9]{10}$', base):
-                contenders = [base]
-            else:
-                contenders = get_contenders(base=base,current=current)
-            for contender in contenders:
-                dicom_dir = "%s/%s" %(base,contender)
-                dcm_folder = os.path.basename(dicom_dir)
-                batch,created = Batch.objects.get_or_create(uid=dcm_folder)
+        if not os.path.isdir(base):
+            continue
+
+        # If it's not a date, the folder itself is the contender
+        if not re.search('[0-9]{10}$', base):
+            count += queue_folders([base], chunk_size=chunk_size)
+            continue
+
+        # A date folder with the same modified time has no new folders
+        mtime = os.stat(base).st_mtime_ns
+        if checkpoints.get(base) == mtime:
+            print('Base %s is unchanged since the last check.' %base)
+            continue
+        contenders = ("%s/%s" %(base,x) for x in get_contenders(base=base))
+        count += queue_folders(contenders, chunk_size=chunk_size)
+        checkpoints[base] = mtime
+
+    save_checkpoints(checkpoints)
+    print("Added %s contenders for processing queue." %count)
+
+
+def queue_folders(dicom_dirs, chunk_size=1000):
+    '''queue folders adds a batch (with status QUEUE) for each folder (from a
+    list or generator) that doesn't have one. The folders are checked against
+    the database, and new batches inserted, a chunk at a time. Returns the
+    number of batches added.
+    '''
+    dicom_dirs = iter(dicom_dirs)
+    count = 0
+    while True:
+        subset = list(islice(dicom_dirs, chunk_size))
+        if len(subset) == 0:
+            break
+        folders = dict((os.path.basename(x), x) for x in subset)
+        known = Batch.objects.filter(uid__in=list(folders)).values_list('uid', flat=True)
+        for uid in known:
+            del folders[uid]
+
+        batches = [Batch(uid=uid, status="QUEUE", logs={'DICOM_DIR': dicom_dir})
+                   for uid, dicom_dir in folders.items()]
+        try:
+            with transaction.atomic():
+                Batch.objects.bulk_create(batches)
+            count += len(batches)
+
+        # The watcher (or another start_queue) added one or more of the same
+        except IntegrityError:
+            for batch in batches:
+                batch,created = Batch.objects.get_or_create(uid=batch.uid,
+                                                            defaults={'status': "QUEUE",
+                                                                      'logs': batch.logs})
                 if created is True:
-                    batch.status = "QUEUE"
-                    batch.logs['DICOM_DIR'] = dicom_dir
-                    count+=1
-                batch.save()
+                    count += 1
+    return count
 
-    print("Added %s contenders for processing queue." %count)
+
+def load_checkpoints():
+    '''load the modified time of each date folder at its last check by
+    update_cached, path --> st_mtime_ns'''
+    if QUEUE_CHECKPOINTS is None or not os.path.exists(QUEUE_CHECKPOINTS):
+        return dict()
+    try:
+        with open(QUEUE_CHECKPOINTS, 'r') as filey:
+            return json.load(filey)
+    except ValueError:
+        bot.warning("Cannot read queue checkpoints %s, checking all folders." %QUEUE_CHECKPOINTS)
+    return dict()
+
+
+def save_checkpoints(checkpoints):
+    '''save the checkpoints for update_cached, replacing the file at once'''
+    if QUEUE_CHECKPOINTS is None:
+        return
+    tmp_file = "%s.tmp" %QUEUE_CHECKPOINTS
+    with open(tmp_file, 'w') as filey:
+        json.dump(checkpoints, filey)
+    os.replace(tmp_file, QUEUE_CHECKPOINTS)
+
+
+def get_redis():
+    '''return a client for the redis instance used as the celery broker'''
+    import redis
+    return redis.StrictRedis(host=REDIS_HOST,
+                             port=REDIS_PORT,
+                             db=REDIS_DB)
+
+
+def get_backlog(client=None):
+    '''get backlog returns the number of tasks waiting in the broker queues
+    (see CELERY_QUEUES), plus the number of batches in flight (PROCESSING
+    or DONEPROCESSING)
+    '''
+    if client is None:
+        client = get_redis()
+    waiting = sum(client.llen(queue.name) for queue in CELERY_QUEUES)
+    working = Batch.objects.filter(status__in=["PROCESSING","DONEPROCESSING"]).count()
+    return waiting + working
+
+
+def get_capacity():
+    '''get capacity returns the number of new folders that can be submitted
+    for import now (None for no limit), for admission control by the
+    watcher and start_queue. Above QUEUE_HIGH_WATER, no new folders are
+    submitted until the backlog is below QUEUE_LOW_WATER again. The
+    state is kept in redis, shared by all processes that submit.
+    '''
+    if QUEUE_HIGH_WATER is None:
+        return None
+
+    low_water = QUEUE_LOW_WATER
+    if low_water is None:
+        low_water = QUEUE_HIGH_WATER
+
+    client = get_redis()
+    backlog = get_backlog(client)
+    holding = client.exists('sendit:backpressure')
+    if holding and backlog < low_water:
+        client.delete('sendit:backpressure')
+        bot.info("Backlog %s is below %s, submitting folders." %(backlog, low_water))
+        holding = False
+    elif not holding and backlog >= QUEUE_HIGH_WATER:
+        client.set('sendit:backpressure', backlog)
+        bot.warning("Backlog %s is over %s, holding folders in QUEUE." %(backlog, QUEUE_HIGH_WATER))
+        holding = True
+
+    if holding:
+        return 0
+    return max(QUEUE_HIGH_WATER - backlog, 0)
+
+
+def queue_folder(dicom_dir):
+    '''queue folder adds a batch (with status QUEUE) for a folder that is
+    not submitted now, to be submitted later by start_queue.
+    '''
+    dcm_folder = os.path.basename(dicom_dir)
+    batch,created = Batch.objects.get_or_create(uid=dcm_folder)
+    if created is True:
+        batch.status = "QUEUE"
+        batch.logs['DICOM_DIR'] = dicom_dir
+        batch.save()
+    return batch
 
 
 def start_queue(subfolder=None, max_count=None):
@@ -146,28 +322,68 @@ def start_queue(subfolder=None, max_count=None):
     start queue will be used to move new Batches (jobs) from the QUEUE to be
     run with celery tasks. The status is changed from QUEUE to NEW when this is done.
     If the QUEUE is empty, we parse the filesystem (and queue new jobs) again.
-    This job submission is done all at once to ensure that we don't have race
-    conditions of multiple workers trying to grab a job at the same time.
+    Batches are claimed (see BatchManager.claim) before they are submitted,
+    so more than one start_queue (eg, on different nodes) can run at once
+    without submitting the same batch twice. Returns the number submitted.
     '''
-    from sendit.apps.main.tasks import import_dicomdir
+    from sendit.apps.main.scheduling import schedule_batches
 
     contenders = Batch.objects.filter(status="QUEUE")
-    if len(contenders) == 0:
+    if not contenders.exists():
         update_cached(subfolder)
         contenders = Batch.objects.filter(status="QUEUE")
 
+    # Only submit as many as the backlog allows
+    capacity = get_capacity()
+    if capacity is not None:
+        if max_count is None or capacity < max_count:
+            max_count = capacity
+        if max_count == 0:
+            print("Backlog is full, no tasks added to the active queue.")
+            return 0
+
+    # The order is chosen by the scheduling policy (QUEUE_POLICY)
+    contenders = schedule_batches(contenders)
+    started = submit_batches(contenders, max_count=max_count)
+    print("Added %s tasks to the active queue." %started)
+    return started
+
+
+def submit_batches(batches, max_count=None, chunk_size=100):
+    '''submit batches will claim batches in QUEUE (in the order given) and
+    submit import_dicomdir for each, up to max_count. A batch claimed by
+    another process in the meantime is skipped. Returns the number submitted.
+    '''
+    from sendit.apps.main.tasks import import_dicomdir
+
+    # not seen folders in queue
+    batches = [x for x in batches if x.logs.get('DICOM_DIR') is not None]
+
     started = 0
-    for batch in contenders:
-        # not seen folders in queue
-        dicom_dir = batch.logs.get('DICOM_DIR')
-        if dicom_dir is not None:
-            import_dicomdir.apply_async(kwargs={"dicom_dir":dicom_dir})
-            started +=1
+    for start in range(0, len(batches), chunk_size):
+        subset = batches[start:start + chunk_size]
         if max_count is not None:
-            if started >= max_count:
-                break
+            subset = subset[:max_count - started]
+        order = dict((x.id, i) for i, x in enumerate(subset))
+        claimed = Batch.objects.claim(ids=list(order))
+        claimed.sort(key=lambda x: order[x.id])
 
-    print("Added %s tasks to the active queue." %started)
+        with import_dicomdir.app.producer_or_acquire() as producer:
+            for i, batch in enumerate(claimed):
+                try:
+                    import_dicomdir.apply_async(kwargs={"dicom_dir":batch.logs['DICOM_DIR']},
+                                                producer=producer)
+
+                # Put back the batches not submitted, for the next start_queue
+                except Exception:
+                    unsent = [x.id for x in claimed[i:]]
+                    Batch.objects.filter(id__in=unsent).update(status="QUEUE")
+                    raise
+                started += 1
+
+        if max_count is not None and started >= max_count:
+            break
+    return started
 
 
 def upload_finished(batches=False, chunk_size=1000):
@@ -194,10 +410,11 @@ def get_contenders(base,current=None, filters=None):
     '''
     if filters is None:
         filters = ['tmp','part']
-    contenders = [x for x in os.listdir(base) if not os.path.isfile(x)]
+    contenders = [x['name'] for x in get_inventory(base,stat=False) if x['is_dir']]
     for ending in filters:
         contenders = [x for x in contenders if not x.endswith(ending)]
 
     if current is not None:
+        current = set(current)
         contenders = [x for x in contenders if x not in current]
     return contenders
@@ -0,0 +1,133 @@
+'''
+An asyncio watcher, reading inotify events for all watch paths on an event
+loop, with folders published to celery in batches off the loop.
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from sendit.logger import bot
+from sendit.apps.watcher.event_processors import submit_folders
+from sendit.apps.watcher.utils import (
+    daemonize,
+    flush_notifier,
+    get_notifier
+)
+from sendit.settings import (
+    WATCHER_FLUSH_INTERVAL,
+    WATCHER_PUBLISH_BATCH,
+    WATCHER_PUBLISH_DELAY
+)
+import asyncio
+
+
+class BatchPublisher(object):
+    '''A batch publisher takes folders to submit (see DicomCelery.submit)
+    without blocking the loop, and submits them (import_dicomdir) in batches
+    from a thread, so a slow broker doesn't stop events being read. A batch
+    is sent when it has batch_size folders, or delay seconds after the
+    first. One batch is sent at a time, and if sending fails (eg, redis
+    is down) the folders are tried again after retry seconds.
+    '''
+    def __init__(self, loop, batch_size=None, delay=None, retry=5):
+        if batch_size is None:
+            batch_size = WATCHER_PUBLISH_BATCH
+        if delay is None:
+            delay = WATCHER_PUBLISH_DELAY
+        self.loop = loop
+        self.batch_size = batch_size
+        self.delay = delay
+        self.retry = retry
+        self.paths = []
+        self.timer = None
+        self.sending = False
+
+    def put(self, path):
+        self.paths.append(path)
+        self.schedule()
+
+    def schedule(self, delay=None):
+        '''send now if there is a full batch, otherwise set a timer'''
+        if len(self.paths) >= self.batch_size:
+            self.send()
+        elif len(self.paths) > 0 and self.timer is None:
+            if delay is None:
+                delay = self.delay
+            self.timer = self.loop.call_later(delay, self.send)
+
+    def send(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sending is True or len(self.paths) == 0:
+            return
+        paths = self.paths[:self.batch_size]
+        self.paths = self.paths[self.batch_size:]
+        self.sending = True
+        future = self.loop.run_in_executor(None, submit_folders, paths)
+        future.add_done_callback(lambda x: self.sent(paths, x))
+
+    def sent(self, paths, future):
+        '''called on the loop when a batch is sent, or failed'''
+        self.sending = False
+        if future.exception() is not None:
+            bot.error("Cannot submit %s folders, trying again: %s" %(len(paths),
+                                                                      future.exception()))
+            self.paths = paths + self.paths
+            return self.schedule(delay=self.retry)
+        bot.log("5|PUBLISHED: %s folders" %(len(paths)))
+        self.schedule()
+
+
+def flush_timer(loop, notifier):
+    '''flush the processors (eg, for quiet folders) and set the next timer'''
+    flush_notifier(notifier)
+    loop.call_later(WATCHER_FLUSH_INTERVAL / 1000.0, flush_timer, loop, notifier)
+
+
+def start_async_watcher(pid_file, **daemon_kwargs):
+    '''start async watcher will daemonize, and then read events for all
+    watch paths on one asyncio loop. Processors with a publisher (see
+    DicomCelery) submit folders with a BatchPublisher. Returns False
+    if this version of pyinotify has no AsyncioNotifier.
+    '''
+    import pyinotify
+    if not hasattr(pyinotify, 'AsyncioNotifier'):
+        bot.error("pyinotify does not provide AsyncioNotifier, upgrade to 0.9.5+")
+        return False
+
+    # The event loop (and inotify) are made in the daemon, after forking
+    daemonize(pid_file=pid_file, **daemon_kwargs)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    notifier = get_notifier(loop=loop)
+
+    publisher = BatchPublisher(loop)
+    for processor in notifier.processors:
+        if hasattr(processor, 'publisher'):
+            processor.publisher = publisher
+
+    loop.call_later(WATCHER_FLUSH_INTERVAL / 1000.0, flush_timer, loop, notifier)
+    try:
+        loop.run_forever()
+    finally:
+        notifier.stop()
+        loop.close()
@@ -34,6 +34,7 @@ SOFTWARE.
 from django.contrib import messages
 from sendit.logger import bot
 from sendit.apps.watcher.utils import (
+    flush_notifier,
     get_daemon_kwargs,
     get_notifier,
     get_pid_file,
@@ -79,6 +80,15 @@ def start_watcher(request=None,as_command=False):
                              request=request)
 
 
+    # The asyncio watcher reads events and publishes on an event loop
+    if settings.WATCHER_BACKEND == "asyncio":
+        from sendit.apps.watcher.async_watcher import start_async_watcher
+        if start_async_watcher(pid_file=get_pid_file(), **get_daemon_kwargs()) is False:
+            return watcher_error(message="pyinotify does not support asyncio.",
+                                 as_command=as_command,
+                                 request=request)
+        return
+
     # Setup watches using pyinotify
     notifier = get_notifier()
 
@@ -92,7 +102,10 @@ def start_watcher(request=None,as_command=False):
 
     # Daemonize, killing any existing process specified in pid file
     daemon_kwargs = get_daemon_kwargs()
-    notifier.loop(daemonize=True, pid_file=pid_file, **daemon_kwargs)
+    notifier.loop(callback=flush_notifier,
+                  daemonize=True,
+                  pid_file=pid_file,
+                  **daemon_kwargs)
     watcher_message(message="Dicom watching has been started.",request=request)
 
 
@@ -26,15 +26,143 @@ SOFTWARE.
 import pyinotify
 from sendit.logger import bot
 from sendit.apps.watcher import signals
+from sendit.apps.main.models import Batch
 from sendit.apps.main.tasks import import_dicomdir
+from sendit.apps.main.tasks.utils import chunks
+from sendit.apps.main.utils import (
+    get_capacity,
+    get_inventory,
+    queue_folder
+)
+from sendit.apps.watcher.utils import get_watch_folders
+from sendit.settings import (
+    WATCHER_DEPTH,
+    WATCHER_METRICS,
+    WATCHER_PARTIAL_EXTENSIONS,
+    WATCHER_PARTIAL_MAX_AGE,
+    WATCHER_QUIET_PERIOD
+)
+import heapq
+import json
+import time
 import os
 
+def submit_folders(paths):
+    '''submit folders will submit import_dicomdir for each of a list of
+    folders, sharing one connection to the broker. Over the backlog limit
+    (see main.utils.get_capacity), a folder waits in QUEUE for start_queue.
+    '''
+    capacity = get_capacity()
+    with import_dicomdir.app.producer_or_acquire() as producer:
+        for path in paths:
+            if capacity is not None:
+                if capacity <= 0:
+                    bot.log("4|QUEUED: %s" %(path))
+                    queue_folder(path)
+                    continue
+                capacity -= 1
+
+            # Here is the celery task to use
+            import_dicomdir.apply_async(kwargs={"dicom_dir":path},
+                                        producer=producer)
+
+
+class PartialFiles(object):
+    '''Partial files tracks files written in chunks by a transfer agent, with
+    a temporary name (eg, filename.part) that is moved to the final name
+    when all chunks are written (see CreateViaChunksSignaler). A transfer
+    that never finishes is forgotten after max_age seconds. The times are
+    kept in a heap, so adding and expiring an entry is O(log n), and the
+    number in flight is counted for each folder.
+    '''
+    def __init__(self, max_age=None, extensions=None):
+        if max_age is None:
+            max_age = WATCHER_PARTIAL_MAX_AGE
+        if extensions is None:
+            extensions = WATCHER_PARTIAL_EXTENSIONS
+        self.max_age = max_age
+        self.extensions = tuple(extensions)
+        self.started = dict()   # path --> time first seen
+        self.timers = []        # heap of (time first seen, path), some are stale
+        self.folders = dict()   # folder --> number of paths in flight
+
+    def __contains__(self, path):
+        return path in self.started
+
+    def __len__(self):
+        return len(self.started)
+
+    def is_partial(self, path):
+        return path.endswith(self.extensions)
+
+    def add(self, path):
+        '''start tracking a partial file, if not already tracked'''
+        self.expire()
+        if path in self.started:
+            return
+        now = time.time()
+        self.started[path] = now
+        heapq.heappush(self.timers, (now, path))
+        folder = os.path.dirname(path)
+        self.folders[folder] = self.folders.get(folder, 0) + 1
+
+    def remove(self, path):
+        '''stop tracking a partial file (moved or deleted), and return
+        True if it was tracked'''
+        if path not in self.started:
+            return False
+        del self.started[path]
+        folder = os.path.dirname(path)
+        self.folders[folder] -= 1
+        if self.folders[folder] == 0:
+            del self.folders[folder]
+        return True
+
+    def expire(self):
+        '''forget partial files older than max_age. Entries in the heap for
+        paths that were removed (or added again) are skipped.'''
+        oldest = time.time() - self.max_age
+        while len(self.timers) > 0 and self.timers[0][0] <= oldest:
+            started, path = heapq.heappop(self.timers)
+            if self.started.get(path) == started:
+                bot.warning("Partial file %s was not finished, ignoring." %(path))
+                self.remove(path)
+
+    def in_folder(self, folder):
+        '''return the number of partial files in flight in a folder'''
+        return self.folders.get(folder, 0)
+
+
 class DicomCelery(pyinotify.ProcessEvent):
     '''class which submits a celery job when a dicom directory is finished
-    creation. This is determined based on not having any tmp extension
+    creation. This is determined based on not having any tmp extension, and
+    no further events for the directory for a quiet period (seconds), so
+    that a directory written file by file is only imported once.
     '''
+    def my_init(self, quiet_period=None, depth=None):
+        if quiet_period is None:
+            quiet_period = WATCHER_QUIET_PERIOD
+        if depth is None:
+            depth = WATCHER_DEPTH
+        self.quiet_period = quiet_period
+        self.depth = depth      # levels of folders (eg, dates) above studies
+        self.deadlines = dict() # path --> time to submit, if no events
+        self.timers = []        # heap of (deadline, path), some are stale
+        self.roots = []         # watched paths, reconciled on overflow
+        self.reconciling = None
+        self.publisher = None   # see async_watcher.BatchPublisher
+        self.partials = PartialFiles()
+        self.metrics = {'Overflows': 0,
+                        'Reconciliations': 0}
+
+    def add_root(self,path):
+        '''add a watched path, see reconcile'''
+        self.roots.append(path)
+
     def is_finished(self,path):
         extsep = os.path.extsep
+        if self.partials.is_partial(path):
+            return False
         if os.path.isdir(path):
             ext = os.path.splitext(path)[1].strip(extsep)
             if ext.startswith('tmp'):
@@ -45,23 +173,159 @@ class DicomCelery(pyinotify.ProcessEvent):
 
     def check_dicomdir(self,event):
         '''check_dicomdir is the main function to call on a folder
-        creation or modification, which both could signal new dicom directories
+        creation or modification, which both could signal new dicom directories.
+        The directory is submitted when it has been quiet (see flush).
         '''
-        if self.is_finished(event.pathname):
+        depth = self.get_depth(event.pathname)
+
+        # Folders above the studies (eg, dates) are watched, not imported
+        if depth is not None and depth <= self.depth:
+            bot.log("2|WATCHED: %s" %(event.pathname))
+
+        elif self.is_finished(event.pathname):
             bot.log("2|FINISHED: %s" %(event.pathname))
-            if event.pathname.lower().startswith("test"):
-                bot.log("Here would be call to import_dicomdir for %s" %(event.pathname))
-            else:  
-                # Here is the celery task to use
-                import_dicomdir.apply_async(kwargs={"dicom_dir":event.pathname})
+            self.touch(event.pathname)
+
+        # An event for a file in a directory waiting to be submitted
+        elif event.path in self.deadlines:
+            self.touch(event.path)
         else:
             bot.log("2|NOTFINISHED: %s" %(event.pathname))
+        self.flush()
+
+    def get_depth(self,path):
+        '''return the depth of a path under its watch path (0 for the
+        watch path), or None if it isn't under one'''
+        for root in self.roots:
+            relpath = os.path.relpath(path, root)
+            if relpath == os.curdir:
+                return 0
+            if not relpath.startswith(os.pardir):
+                return relpath.count(os.sep) + 1
+
+    def touch(self,path):
+        '''touch will (re)start the quiet period for a directory. The last
+        deadline is kept for the path, and earlier ones in the heap are
+        skipped when they come up.
+        '''
+        deadline = time.time() + self.quiet_period
+        self.deadlines[path] = deadline
+        heapq.heappush(self.timers, (deadline, path))
+
+    def flush(self):
+        '''flush will submit each directory that has had no events for the
+        quiet period. It is called on each event, and by the notifier
+        (see watcher.utils.get_notifier) when there are none.
+        '''
+        if self.reconciling is not None:
+            try:
+                next(self.reconciling)
+            except StopIteration:
+                self.reconciling = None
+
+        self.partials.expire()
+        now = time.time()
+        held = []
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            deadline, path = heapq.heappop(self.timers)
+            if self.deadlines.get(path) != deadline:
+                continue
+            del self.deadlines[path]
+            if not os.path.isdir(path):
+                bot.log("2|REMOVED: %s" %(path))
+                continue
+
+            # Files still being transferred in chunks, wait for them
+            if self.partials.in_folder(path) > 0 or self.has_partial_files(path):
+                bot.log("2|PARTIAL: %s" %(path))
+                held.append(path)
+                continue
+            self.submit(path)
+
+        for path in held:
+            self.touch(path)
+
+    def has_partial_files(self,path):
+        '''has partial files returns True if a folder has files still being
+        transferred in chunks (see PartialFiles), read when it is quiet, as
+        files in study folders (not watched) don't send events. A partial
+        file not changed for max_age seconds is abandoned, and ignored.
+        '''
+        oldest = time.time() - self.partials.max_age
+        for entry in get_inventory(path):
+            if self.partials.is_partial(entry['name']) and entry['mtime'] > oldest:
+                return True
+        return False
+
+    def submit(self,path):
+        bot.log("3|QUIET: %s" %(path))
+        if path.lower().startswith("test"):
+            bot.log("Here would be call to import_dicomdir for %s" %(path))
+
+        # The asyncio watcher publishes from a queue, without waiting
+        elif self.publisher is not None:
+            self.publisher.put(path)
+        else:
+            submit_folders([path])
+
+
+    def reconcile(self,chunk_size=1000):
+        '''reconcile will compare the folders in the watched paths to the
+        batches known to the application, and folders that are missing
+        (eg, created while events were lost) are handled as if seen. This
+        is a generator, stepped through one chunk of folders each flush,
+        so events are still processed while it runs.
+        '''
+        start_time = time.time()
+        found = 0
+        for root in self.roots:
+            for parent in get_watch_folders(root, depth=self.depth):
+                if self.get_depth(parent) != self.depth:
+                    continue
+                folders = [x['path'] for x in get_inventory(parent, stat=False) if x['is_dir']]
+                for subset in chunks(folders, chunk_size):
+                    names = [os.path.basename(x) for x in subset]
+                    known = set(Batch.objects.filter(uid__in=names).values_list('uid', flat=True))
+                    for folder in subset:
+                        if os.path.basename(folder) in known or folder in self.deadlines:
+                            continue
+                        if self.is_finished(folder):
+                            bot.log("2|RECONCILED: %s" %(folder))
+                            self.touch(folder)
+                            found += 1
+                    yield
+
+        self.metrics['Reconciliations'] += 1
+        self.metrics['LastReconcileTime'] = start_time
+        self.metrics['LastReconcileSeconds'] = time.time() - start_time
+        self.metrics['LastReconcileFound'] = found
+        self.save_metrics()
+
+    def save_metrics(self):
+        '''write the watcher metrics, exposed with the api metrics, replacing
+        the file at once. A failed write is logged, and the watcher goes on.
+        '''
+        tmp_file = "%s.tmp" %WATCHER_METRICS
+        try:
+            with open(tmp_file,'w') as filey:
+                json.dump(self.metrics, filey)
+            os.replace(tmp_file, WATCHER_METRICS)
+        except OSError as e:
+            bot.warning("Cannot write watcher metrics to %s: %s" %(WATCHER_METRICS, e))
 
 
     def process_IN_CREATE(self, event):
         bot.log("1|CREATE EVENT: %s" %(event.pathname))
+        if self.partials.is_partial(event.pathname):
+            self.partials.add(event.pathname)
         self.check_dicomdir(event)
 
+    def process_IN_DELETE(self, event):
+        '''a partial file that is deleted was an aborted transfer'''
+        if self.partials.remove(event.pathname):
+            bot.log("1|DELETE EVENT: %s" %(event.pathname))
+            self.check_dicomdir(event)
+
     def process_IN_MODIFY(self, event):
         bot.log("1|MODIFY EVENT: %s" %(event.pathname))
         self.check_dicomdir(event)
@@ -76,8 +340,39 @@ class DicomCelery(pyinotify.ProcessEvent):
 
     def process_IN_MOVED_TO(self, event):
         bot.log("1|MOVEDTO EVENT: %s" %(event.pathname))
+        # A partial file (or folder) moved to its final name is finished
+        src_pathname = getattr(event, 'src_pathname', None)
+        if src_pathname is not None:
+            self.partials.remove(src_pathname)
         self.check_dicomdir(event)
 
+    def process_IN_Q_OVERFLOW(self, event):
+        '''the kernel queue overflowed and events were lost, so the watched
+        paths are reconciled (again, if already started)'''
+        bot.warning("1|OVERFLOW EVENT: reconciling %s" %(self.roots))
+        self.metrics['Overflows'] += 1
+        self.metrics['LastOverflowTime'] = time.time()
+        self.reconciling = self.reconcile()
+        self.save_metrics()
+
+
+class OverflowSignaler(pyinotify.ProcessEvent):
+    '''The default processor for the notifier, for events without a watch.
+    IN_Q_OVERFLOW (for all watches) is sent to each of the processors.
+    '''
+    def my_init(self, processors=None):
+        if processors is None:
+            processors = []
+        self.processors = processors
+
+    def process_IN_Q_OVERFLOW(self, event):
+        for processor in self.processors:
+            if hasattr(processor, 'process_IN_Q_OVERFLOW'):
+                processor.process_IN_Q_OVERFLOW(event)
+
+    def process_default(self, event):
+        pass
+
 
 
 class AllEventsPrinter(pyinotify.ProcessEvent):
@@ -245,42 +540,33 @@ class CreateViaChunksSignaler(pyinotify.ProcessEvent):
     of the temporary .part file all the way through moving it to the final
     filename.
     """
-    def my_init(self):
+    def my_init(self, max_age=None, extensions=None):
         """
-        Setup a dict we can track .part files in.
-
-        Also define the max_allowable_age for an entry in the tracking dict.
-        """
-        self.temp_files = {}
-
-        from datetime import timedelta
-        self.max_allowed_age = timedelta(hours=6)
-
-    def sleepshop(self):
+        Setup the tracking of .part files, which are forgotten when older
+        than max_age seconds (see PartialFiles).
         """
-        Remove values from the temp_files instance variable when they
-        have reached an unacceptable age.
-        """
-        from datetime import datetime
-        now = datetime.now()
-        for filename, timestamp in dict(self.temp_files).iteritems():
-            if now - timestamp > self.max_allowed_age:
-                del self.temp_files[filename]
+        if extensions is None:
+            extensions = ['.part']
+        self.temp_files = PartialFiles(max_age=max_age,
+                                       extensions=extensions)
 
     def process_IN_CREATE(self, event):
         """
         The IN_CREATE event will be the creation of the .part temporary file.
 
         So instead of sending the in_create signal now, we merely start to
-        track the state of this temporary file. We store a current timestamp
-        in the tracking dict so we can cull any values which have been around
-        too long.
+        track the state of this temporary file. Files which have been around
+        too long are culled as they come up in the tracking heap.
         """
-        self.sleepshop()
+        if self.temp_files.is_partial(event.pathname):
+            self.temp_files.add(event.pathname)
+        self.temp_files.expire()
 
-        if event.pathname.endswith('.part'):
-            import datetime
-            self.temp_files[event.pathname] = datetime.datetime.now()
+    def process_IN_DELETE(self, event):
+        """
+        An aborted transfer may delete the .part file, stop tracking it.
+        """
+        self.temp_files.remove(event.pathname)
 
     def process_IN_MOVED_TO(self, event):
         """
@@ -292,8 +578,8 @@ class CreateViaChunksSignaler(pyinotify.ProcessEvent):
         Note: IN_MOVED_FROM must be watched as well for src_pathname to be
         set.
         """
-        if event.src_pathname and event.src_pathname in self.temp_files:
-            del self.temp_files[event.src_pathname]
+        src_pathname = getattr(event, 'src_pathname', None)
+        if src_pathname and self.temp_files.remove(src_pathname):
             signals.in_create.send(sender=self, event=event)
 
-        self.sleepshop()
+        self.temp_files.expire()
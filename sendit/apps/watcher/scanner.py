@@ -0,0 +1,220 @@
+'''
+A polling backend for the watcher, for data folders (eg, NFS or SMB mounts)
+where inotify doesn't see changes made by other clients.
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+from sendit.logger import bot
+from sendit.apps.main.utils import get_inventory
+from sendit.settings import (
+    WATCHER_DEPTH,
+    WATCHER_INDEX,
+    WATCHER_POLL_INTERVAL,
+    WATCHER_QUIET_PERIOD
+)
+from collections import namedtuple
+import json
+import time
+import os
+
+
+# The attributes of a pyinotify event that the event processors use
+ScanEvent = namedtuple('ScanEvent', ['path', 'name', 'pathname', 'dir', 'maskname'])
+
+
+class DirectoryScanner(object):
+    '''A directory scanner finds new and changed folders in the watch paths by
+    polling, and sends them to the event processors as pyinotify events
+    (IN_CREATE and IN_MODIFY). An index of the modified time and number of
+    entries of each directory is kept in a file, so a watch path is only
+    read again if it changed (eg, a folder was added or renamed), and the
+    scanner can be restarted without finding every folder again. Folders
+    that changed recently (active) are checked on each flush, until they
+    have been quiet for the quiet period.
+    '''
+    def __init__(self, index_file=None, interval=None, quiet_period=None, depth=None):
+        if depth is None:
+            depth = WATCHER_DEPTH
+        if index_file is None:
+            index_file = WATCHER_INDEX
+        if interval is None:
+            interval = WATCHER_POLL_INTERVAL
+        if quiet_period is None:
+            quiet_period = WATCHER_QUIET_PERIOD
+        self.index_file = index_file
+        self.interval = interval
+        self.quiet_period = quiet_period
+        self.depth = depth       # levels of folders (eg, dates) above studies
+        self.watches = []        # (path, processor)
+        self.children = dict()   # path --> set of folder paths
+        self.active = dict()     # folder path --> time of last change
+        self.last_scan = 0
+        self.index = self.load()
+        for folder in self.index:
+            self.children.setdefault(os.path.dirname(folder), set()).add(folder)
+
+    def load(self):
+        '''load the index of directories, path --> [mtime, count]'''
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r') as filey:
+                    return json.load(filey)
+            except ValueError:
+                bot.warning("Cannot read watcher index %s, starting again." %self.index_file)
+        return dict()
+
+    def save(self):
+        '''save the index of directories, replacing the file at once'''
+        tmp_file = "%s.tmp" %self.index_file
+        with open(tmp_file, 'w') as filey:
+            json.dump(self.index, filey)
+        os.replace(tmp_file, self.index_file)
+
+    def add_watch(self, path, processor):
+        '''add a path to scan for new folders, sent to the processor'''
+        path = path.rstrip(os.sep)
+        self.watches.append((path, processor))
+        bot.debug("Adding scan of %s, every %s seconds" %(path, self.interval))
+
+    def get_entry(self, path, known=None):
+        '''get entry returns [mtime, count] for a directory, only reading
+        the directory (for the count) if the modified time changed.
+        '''
+        mtime = os.stat(path).st_mtime_ns
+        if known is not None and known[0] == mtime:
+            return known
+        return [mtime, len(os.listdir(path))]
+
+    def flush(self):
+        '''flush is called by the notifier loop (see watcher.utils.flush_notifier)
+        when it wakes up. The active folders are checked each time, and the
+        watch paths are scanned every interval. The index is saved if
+        anything changed.
+        '''
+        changed = self.check_active()
+        if time.time() - self.last_scan >= self.interval:
+            self.last_scan = time.time()
+            for path, processor in self.watches:
+                changed = self.scan(path, processor) or changed
+        if changed is True:
+            self.save()
+
+    def scan(self, path, processor, level=0, baseline=None):
+        '''scan a watch path, if it changed since the last scan. New folders
+        are sent to the processor, and removed folders are forgotten. The
+        first scan of a path only builds the index, like inotify, folders
+        that are already there are not sent. With dated folders (depth),
+        the folders above the studies are scanned in the same way, each
+        read again only if it changed.
+        '''
+        known = self.index.get(path)
+        if baseline is None:
+            baseline = known is None
+        try:
+            entry = self.get_entry(path, known=known)
+        except FileNotFoundError:
+            if level == 0:
+                bot.warning("Cannot scan %s, it does not exist." %path)
+            return False
+
+        changed = False
+        if entry != known:
+            changed = True
+            inventory = get_inventory(path, stat=False)
+            folders = set(x['path'] for x in inventory if x['is_dir'])
+            children = self.children.get(path, set())
+
+            for folder in folders - children:
+                # A folder above the studies (eg, a date) is scanned below
+                if level < self.depth:
+                    continue
+                if baseline is True:
+                    self.index[folder] = [None, None]
+                    continue
+                try:
+                    self.index[folder] = self.get_entry(folder)
+                except FileNotFoundError:
+                    continue
+                self.active[folder] = time.time()
+                self.send(processor, folder, "IN_CREATE")
+
+            for folder in children - folders:
+                self.forget(folder)
+
+            self.children[path] = folders
+            self.index[path] = [entry[0], len(inventory)]
+
+        # Folders above the studies are checked on each scan, a change in
+        # a folder doesn't change the modified time of its parent
+        if level < self.depth:
+            for folder in self.children.get(path, set()):
+                changed = self.scan(folder, processor, level + 1, baseline) or changed
+        return changed
+
+    def forget(self, folder):
+        '''forget a folder that was removed, and any folders under it'''
+        self.index.pop(folder, None)
+        self.active.pop(folder, None)
+        for child in self.children.pop(folder, set()):
+            self.forget(child)
+
+    def check_active(self):
+        '''check active folders for changes (eg, files still being written),
+        each sent to the processor. A folder is no longer checked once
+        it has been quiet for the quiet period.
+        '''
+        changed = False
+        for folder, last_change in list(self.active.items()):
+            known = self.index.get(folder)
+            try:
+                entry = self.get_entry(folder, known=known)
+            except FileNotFoundError:
+                del self.active[folder]
+                continue
+            if entry != known:
+                self.index[folder] = entry
+                self.active[folder] = time.time()
+                self.send(self.get_processor(folder), folder, "IN_MODIFY")
+                changed = True
+            elif time.time() - last_change > self.quiet_period:
+                del self.active[folder]
+        return changed
+
+    def get_processor(self, folder):
+        '''return the processor for the watch path of a folder'''
+        for path, processor in self.watches:
+            if folder.startswith(path + os.sep):
+                return processor
+
+    def send(self, processor, pathname, maskname):
+        '''send an event for a folder to the processor, as pyinotify would'''
+        if processor is None:
+            return
+        event = ScanEvent(path=os.path.dirname(pathname),
+                          name=os.path.basename(pathname),
+                          pathname=pathname,
+                          dir=True,
+                          maskname=maskname)
+        method = getattr(processor, "process_%s" %maskname, None)
+        if method is not None:
+            method(event)
@@ -0,0 +1,44 @@
+from django.test import SimpleTestCase
+from sendit.apps.watcher.event_processors import DicomCelery
+from unittest.mock import patch
+import shutil
+import tempfile
+import os
+
+
+class TestChunkedTransfers(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.study = os.path.join(self.tmpdir, 'study')
+        os.mkdir(self.study)
+        open(os.path.join(self.study, 'IM0001.dcm'), 'w').close()
+        open(os.path.join(self.study, 'IM0002.dcm.part'), 'w').close()
+        self.processor = DicomCelery(quiet_period=0)
+        self.processor.add_root(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hold_partial_folder(self):
+        '''a quiet folder with a partial file is held until it is moved'''
+        with patch.object(self.processor, 'submit') as submit:
+            self.processor.touch(self.study)
+            self.processor.flush()
+            submit.assert_not_called()
+            self.assertIn(self.study, self.processor.deadlines)
+
+            os.rename(os.path.join(self.study, 'IM0002.dcm.part'),
+                      os.path.join(self.study, 'IM0002.dcm'))
+            self.processor.flush()
+            submit.assert_called_once_with(self.study)
+
+    def test_abandoned_partial_file(self):
+        '''a partial file older than the max age doesn't hold the folder'''
+        self.processor.partials.max_age = 60
+        partial = os.path.join(self.study, 'IM0002.dcm.part')
+        os.utime(partial, (0, 0))
+        with patch.object(self.processor, 'submit') as submit:
+            self.processor.touch(self.study)
+            self.processor.flush()
+            submit.assert_called_once_with(self.study)
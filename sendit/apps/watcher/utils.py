@@ -34,9 +34,15 @@ from django.core.management.base import (
 
 from sendit.settings import (
     BASE_DIR,
-    MEDIA_ROOT
+    MEDIA_ROOT,
+    WATCHER_BACKEND,
+    WATCHER_DEPTH,
+    WATCHER_EXCLUDE,
+    WATCHER_FLUSH_INTERVAL
 )
 from django.conf import settings
+import atexit
+import json
 import os
 
 media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
@@ -101,9 +107,10 @@ def get_pid_file(quiet=False):
     return pid_file
 
 
-def get_notifier():
+def get_notifier(loop=None):
     '''get notifier will return a basic pyinotify watch manager
-    based on the user's inotify watch paths in settings.
+    based on the user's inotify watch paths in settings. If an asyncio
+    loop is given, the notifier reads events on the loop (see async_watcher).
     if there is an error, returns None.
     '''
  
@@ -115,17 +122,152 @@ def get_notifier():
 
     level = get_level()
     wm = pyinotify.WatchManager()
+    processors = []
+
+    # The scanner polls the watch paths, the notifier only wakes it up
+    scanner = None
+    if WATCHER_BACKEND == "poll":
+        from sendit.apps.watcher.scanner import DirectoryScanner
+        scanner = DirectoryScanner()
+        processors.append(scanner)
+
     for path, mask, processor_cls in settings.INOTIFIER_WATCH_PATHS:
         cls_path = '.'.join(processor_cls.split('.')[0:-1])
         cls = processor_cls.split('.')[-1]
         mod = __import__(cls_path, globals(), locals(), [cls], level)
         Processor = getattr(mod, cls)
-        wm.add_watch(path, mask, proc_fun=Processor())
+        processor = Processor()
+        if scanner is not None:
+            scanner.add_watch(path, processor)
+
+        # Folders above the studies (eg, dates) are watched, and new ones added
+        else:
+            exclude_filter = get_exclude_filter(path)
+            for folder in get_watch_folders(path):
+                wm.add_watch(folder,
+                             mask,
+                             proc_fun=processor,
+                             auto_add=WATCHER_DEPTH > 0,
+                             exclude_filter=exclude_filter)
+        if hasattr(processor, 'add_root'):
+            processor.add_root(path)
+        processors.append(processor)
         bot.debug("Adding watch on %s, processed by %s" %(path, processor_cls))
 
-    notifier = pyinotify.Notifier(wm)
+    # Queue overflow has no watch, and goes to the default processor
+    from sendit.apps.watcher.event_processors import OverflowSignaler
+    default = OverflowSignaler(processors=processors)
+
+    # Processors are flushed after reading events, and on a timer by the loop
+    if loop is not None:
+        notifier = pyinotify.AsyncioNotifier(wm,
+                                             loop,
+                                             callback=flush_notifier,
+                                             default_proc_fun=default)
+
+    # Wake up when there are no events, to flush processors (see flush_notifier)
+    else:
+        notifier = pyinotify.Notifier(wm,
+                                      default_proc_fun=default,
+                                      timeout=WATCHER_FLUSH_INTERVAL)
+    notifier.processors = processors
     return notifier
 
+
+def get_exclude_filter(root, depth=None, exclude=None):
+    '''get exclude filter returns a function for pyinotify, True for a folder
+    under a watch path (root) that should not be watched: a study folder,
+    deeper than depth, or a folder ending with one of exclude (eg, tmp)
+    '''
+    if depth is None:
+        depth = WATCHER_DEPTH
+    if exclude is None:
+        exclude = WATCHER_EXCLUDE
+
+    def exclude_filter(path):
+        relpath = os.path.relpath(path, root)
+        if relpath == os.curdir:
+            return False
+        if relpath.count(os.sep) + 1 > depth:
+            return True
+        return any(path.endswith(x) for x in exclude)
+
+    return exclude_filter
+
+
+def get_watch_folders(root, depth=None, exclude=None):
+    '''get watch folders returns the watch path (root), and the folders under
+    it to watch, down to depth (see get_exclude_filter). Each level is
+    read once, and study folders are not read.
+    '''
+    from sendit.apps.main.utils import get_inventory
+    exclude_filter = get_exclude_filter(root, depth, exclude)
+    folders = [root]
+    level = [root]
+    while len(level) > 0:
+        found = []
+        for folder in level:
+            try:
+                found += [x['path'] for x in get_inventory(folder, stat=False)
+                          if x['is_dir'] and not exclude_filter(x['path'])]
+            except FileNotFoundError:
+                continue
+        folders += found
+        level = found
+    return folders
+
+
+def flush_notifier(notifier):
+    '''flush notifier is the callback for the notifier loop, and calls flush
+    for each processor that holds events (eg, DicomCelery waits for a
+    directory to be quiet before submitting it). With the poll backend,
+    the scanner is flushed first, to scan for new events.
+    '''
+    for processor in getattr(notifier, 'processors', []):
+        if hasattr(processor, 'flush'):
+            processor.flush()
+
+
+def daemonize(pid_file, stdout=os.devnull, stderr=os.devnull):
+    '''daemonize will detach the process (as pyinotify does for the notifier
+    loop), write the pid file, and send output to the log files. The pid
+    file is removed when the process exits.
+    '''
+    if os.path.lexists(pid_file):
+        raise CommandError('Cannot daemonize: pid file %s already exists.' %pid_file)
+
+    if os.fork() != 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    os.chdir('/')
+    os.umask(0o022)
+
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(os.open(stdout, os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0o0600), 1)
+    os.dup2(os.open(stderr, os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0o0600), 2)
+
+    fd_pid = os.open(pid_file, os.O_WRONLY|os.O_CREAT|os.O_NOFOLLOW|os.O_EXCL, 0o0600)
+    os.write(fd_pid, ("%s\n" %os.getpid()).encode('utf-8'))
+    os.close(fd_pid)
+    atexit.register(lambda: os.unlink(pid_file))
+
+
+def get_watcher_metrics():
+    '''return the metrics written by the watcher (eg, queue overflows and
+    reconciliation), or an empty dictionary if there are none.
+    '''
+    metrics = dict()
+    if os.path.exists(settings.WATCHER_METRICS):
+        with open(settings.WATCHER_METRICS,'r') as filey:
+            try:
+                metrics = json.load(filey)
+            except ValueError:
+                pass
+    return metrics
+
+
 def verify_monitor_paths(return_message=False):
     '''verify monitor paths will check for monitor paths. If return_message is
     True, it returns the error message for another process to call/deal with, and None
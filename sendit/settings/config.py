@@ -12,6 +12,21 @@ ANONYMIZE_RESTFUL=True
 STANFORD_APPLICATION_CREDENTIALS='/var/www/images/.stanford'
 os.environ['STANFORD_CLIENT_SECRETS'] = STANFORD_APPLICATION_CREDENTIALS
 
+# Calls to DASHER from all workers are limited to DASHER_RATE per second (with
+# bursts of up to DASHER_BURST), and to DASHER_CONCURRENCY at once, fewer if
+# calls fail. A worker waits its turn. A call that fails is tried again (with
+# a longer wait each time) up to DASHER_RETRIES times. If None, no limit
+DASHER_RATE=None
+DASHER_BURST=10
+DASHER_CONCURRENCY=None
+DASHER_RETRIES=5
+
+# If set, batches get identifiers together, up to DASHER_COALESCE_SIZE batches
+# in one request to DASHER, sent DASHER_COALESCE_WINDOW seconds after the first
+# batch is ready (or when there are enough). If None, one request per batch
+DASHER_COALESCE_SIZE=None
+DASHER_COALESCE_WINDOW=2
+
 # If True, scrub pixel data for images identified by header "Burned in Annotation" = "NO"
 ANONYMIZE_PIXELS=False # currently not supported 
 
@@ -36,6 +51,101 @@ DATA_BASE = "/data"
 DATA_SUBFOLDER=None  # ignored if DATA_INPUT_FOLDERS is set
 DATA_INPUT_FOLDERS=None
 
+# Admission control: when the tasks waiting in the broker plus the batches in
+# PROCESSING or DONEPROCESSING reach QUEUE_HIGH_WATER, new folders are kept
+# in QUEUE status (and not submitted by the watcher or start_queue) until
+# this is below QUEUE_LOW_WATER. If None, folders are always submitted.
+QUEUE_HIGH_WATER=None
+QUEUE_LOW_WATER=None
+
+# The order that start_queue submits batches in QUEUE, one of "fifo" (the order
+# added), "smallest" (smallest folder first), "aging" (smallest first, but a
+# folder counts as half its size for every QUEUE_AGING_SECONDS it waits), "fair"
+# (weighted fair share of bytes across input folders, with QUEUE_FAIR_WEIGHTS
+# as {folder: weight}, default 1), or the dotted path to a function. The policy
+# orders the QUEUE_POLICY_WINDOW batches that have waited longest
+QUEUE_POLICY="fifo"
+QUEUE_POLICY_WINDOW=1000
+QUEUE_AGING_SECONDS=60*60
+QUEUE_FAIR_WEIGHTS=dict()
+
+# The scheduler (manage.py run_scheduler) keeps batches in flight up to the target
+# for each status in SCHEDULER_TARGETS (NEW is submitted or importing, PROCESSING
+# is de-identifying), checking every SCHEDULER_INTERVAL seconds. It looks for new
+# folders only when QUEUE runs low, at most every SCHEDULER_RESCAN_INTERVAL seconds.
+# If SCHEDULER_UPLOAD_INTERVAL is set, DONEPROCESSING batches are uploaded that often.
+# A batch NEW for SCHEDULER_STALE_SECONDS that isn't importing (eg, the task was lost
+# with a worker) is put back in QUEUE. If None, it is left as is
+SCHEDULER_TARGETS={"NEW": 10, "PROCESSING": 20}
+SCHEDULER_INTERVAL=5
+SCHEDULER_RESCAN_INTERVAL=5*60
+SCHEDULER_UPLOAD_INTERVAL=None
+SCHEDULER_STALE_SECONDS=60*60
+
+# The scheduler state, in LOG_DIR with the watcher metrics, shown with api metrics
+SCHEDULER_METRICS=os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                               'logs', 'scheduler.metrics')
+
+# start_queue keeps the modified time of each date folder it checked in this
+# file, and skips the folder next time if unchanged. If None, always checked
+QUEUE_CHECKPOINTS=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'queue.checkpoints')
+
+# A task working on a batch holds a lease so it isn't run twice at once. The
+# lease is renewed while the task runs, and a lease left by a worker that died
+# expires after this many seconds. A task submitted while the lease is held
+# is tried again after this long
+TASK_LEASE_SECONDS=5*60
+
+#####################################################
+# IMPORT
+#####################################################
+
+# If True, only the dicom header is read on import (stopping before PixelData)
+# If None, defaults to True when ANONYMIZE_PIXELS is False
+IMPORT_HEADER_ONLY=None
+
+# Optionally, a list of header fields to read on import, eg:
+# IMPORT_HEADER_TAGS=["StudyDate", "SeriesNumber", "ImageType"]
+# Fields required by the import are always added. If None, all are read.
+IMPORT_HEADER_TAGS=None
+
+# Number of processes to parse, filter and stage files of one batch
+# If 1, files are imported one at a time by the task
+IMPORT_WORKERS=1
+
+# Number of images added to the database at once on import
+IMPORT_CHUNK_SIZE=500
+
+# How files are staged to the application media on import, one of:
+# auto: hard link if on the same filesystem, then reflink, then copy
+# hardlink, reflink: as auto, but only trying the one method before copy
+# copy: in kernel copy (copy_file_range or sendfile)
+IMPORT_STAGING="auto"
+
+# If True, an import keeps a manifest of the files staged for the batch,
+# and an import that is run again (eg, after a worker died) resumes from it
+IMPORT_RESUME=True
+
+# If True, an md5 checksum of each file is kept in the manifest. This reads
+# every file in full (not only the header), and is needed for IMPORT_DUPLICATES
+IMPORT_CHECKSUM=False
+
+# If "skip", images already uploaded with another batch (the same
+# SOPInstanceUID and checksum) are skipped, with IMPORT_CHECKSUM=True.
+# If None, all are processed.
+IMPORT_DUPLICATES=None
+
+# A batch with more images (IMPORT_SHARD_COUNT) or bytes (IMPORT_SHARD_SIZE)
+# than these is split into batches of whole series, processed in parallel
+# and joined again for upload. If None, batches are not split.
+IMPORT_SHARD_COUNT=None
+IMPORT_SHARD_SIZE=None
+
+# If True, each series of a batch is de-identified as soon as it is imported,
+# instead of waiting for the entire batch (one DASHER request per series)
+PIPELINE_SERIES=False
+
 #####################################################
 # STORAGE
 #####################################################
@@ -17,7 +17,26 @@ CELERY_TIMEZONE = "UTC"
 CELERY_DEFAULT_QUEUE = 'default'
 CELERY_QUEUES = (
     Queue('default', Exchange('default'), routing_key='default'),
+    Queue('import', Exchange('import'), routing_key='import'),
+    Queue('deid', Exchange('deid'), routing_key='deid'),
+    Queue('upload', Exchange('upload'), routing_key='upload'),
+    Queue('cleanup', Exchange('cleanup'), routing_key='cleanup'),
 )
+
+# Each stage has a queue, so workers for each can be sized on their own
+# (see docker-compose.yml). Import is disk bound, de-identification waits
+# on DASHER and rewrites headers, and upload waits on Google Storage
+CELERY_ROUTES = {
+    'sendit.apps.main.tasks.get.import_dicomdir': {'queue': 'import'},
+    'sendit.apps.main.tasks.get.get_identifiers': {'queue': 'deid'},
+    'sendit.apps.main.tasks.get.get_identifiers_many': {'queue': 'deid'},
+    'sendit.apps.main.tasks.update.replace_identifiers': {'queue': 'deid'},
+    'sendit.apps.main.tasks.update.scrub_pixels': {'queue': 'deid'},
+    'sendit.apps.main.tasks.pipeline.process_series': {'queue': 'deid'},
+    'sendit.apps.main.tasks.pipeline.finish_pipeline': {'queue': 'deid'},
+    'sendit.apps.main.tasks.finish.upload_storage': {'queue': 'upload'},
+    'sendit.apps.main.tasks.finish.clean_up': {'queue': 'cleanup'},
+}
 CELERY_IMPORTS = ('sendit.apps.main.tasks', )
 
 CELERY_RESULT_BACKEND = 'redis://%s:%d/%d' %(REDIS_HOST,REDIS_PORT,REDIS_DB)
@@ -18,3 +18,37 @@ def generate_watch_paths():
 INOTIFIER_WATCH_PATHS = generate_watch_paths()
 INOTIFIER_DAEMON_STDOUT = os.path.join(LOG_DIR,'watcher.out')
 INOTIFIER_DAEMON_STDERR = os.path.join(LOG_DIR,'watcher.err')
+
+# Metrics (eg, queue overflows) written by the watcher, shown with api metrics
+WATCHER_METRICS = os.path.join(LOG_DIR,'watcher.metrics')
+
+# Levels of folders between a watch path and the study folders, for example 1
+# for /data/<date>/<study>. These are watched (and new ones added), study
+# folders and folders ending with one of WATCHER_EXCLUDE are not
+WATCHER_DEPTH = 0
+WATCHER_EXCLUDE = ['tmp', 'part']
+
+# A folder is imported when there have been no events for it for this
+# many seconds, so a folder written file by file is imported once
+WATCHER_QUIET_PERIOD = 10
+
+# Files (or folders) written in chunks by a transfer agent, with one of these
+# extensions until moved to the final name. A folder isn't imported while it
+# has any, unless older than WATCHER_PARTIAL_MAX_AGE seconds (abandoned)
+WATCHER_PARTIAL_EXTENSIONS = ['.part']
+WATCHER_PARTIAL_MAX_AGE = 6*60*60
+
+# Milliseconds the watcher waits for events before checking for quiet folders
+WATCHER_FLUSH_INTERVAL = 1000
+
+# inotify doesn't see changes made by other clients of a network mount (eg, NFS).
+# With "poll", the watch paths are scanned every WATCHER_POLL_INTERVAL seconds
+# instead, and an index of directories is kept in WATCHER_INDEX.
+# With "asyncio", events are read on an event loop, and folders are submitted
+# in batches (up to WATCHER_PUBLISH_BATCH, waiting WATCHER_PUBLISH_DELAY seconds)
+# from a thread, so a slow broker doesn't stop events from being read
+WATCHER_BACKEND = "inotify"
+WATCHER_PUBLISH_BATCH = 100
+WATCHER_PUBLISH_DELAY = 0.5
+WATCHER_POLL_INTERVAL = 30
+WATCHER_INDEX = os.path.join(BASE_DIR,'watcher.index')